@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import RegionalPhillipsCurve as rpc
+import Regression as rg
+
+# The most regression responses kept by the server, on top of the result cache every worker keeps
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+# The largest request line or header line the server reads
+MAX_LINE_BYTES = 8192
+
+_STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+# Regression responses keyed by the normalized specification and the data version, in least recently used order
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+class RequestError(Exception):
+    """
+    Raised by the handlers for a request that can't be answered, with the HTTP status to answer it with.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _load_worker():
+    """
+    Runs once in every worker process: the datasets and their lookup tables are loaded here so every fit the worker runs reuses them.
+    """
+
+    rpc.get_lookup_table("Unemployment")
+    rpc.get_lookup_table("Inflation")
+
+
+def _fit(time_period, type_of_regression, type_of_fit, leverage):
+    """
+    Runs a regression in a worker process and returns the numbers of every region and the removed dates (as Strings).
+    """
+
+    output_mapping, removed = rg.main_function(time_period, type_of_regression, type_of_fit, leverage, numeric_only=True)
+    removed = {region: [str(date)[:10] for date in dates] for region, dates in removed.items()} if removed else {}
+
+    return output_mapping, removed
+
+
+def _clean(value):
+    """
+    Turns a result into something json can encode: numpy arrays and numbers become lists and Python numbers, and NaN and infinity become
+    null (which unlike NaN and Infinity is valid json).
+    """
+
+    if isinstance(value, dict):
+        return {str(key): _clean(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_clean(item) for item in value]
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value) if math.isfinite(value) else None
+
+    return value
+
+
+def _parameter(query, name, default = None):
+    """
+    Returns a query parameter of a request (a RequestError is raised if it is missing and has no default).
+    """
+
+    if name in query:
+        return query[name][-1]
+    if default is None:
+        raise RequestError(400, f"Missing query parameter {name!r}.")
+
+    return default
+
+
+def _regional_values(variable, query):
+    """
+    Answers /unemployment and /inflation: the rate of every region for one date.
+    """
+
+    date = _parameter(query, "date")
+    horizon = _parameter(query, "horizon", "Year over year")
+
+    values = rpc.lookup_regional_values(variable, [date], horizon)[0]
+    regions = rpc.get_lookup_table(variable, horizon)["regions"]
+
+    payload = {"variable": variable, "date": date, "rates": dict(zip(regions, values))}
+    if variable == "Inflation":
+        payload["horizon"] = horizon
+
+    return payload
+
+
+def _series(query):
+    """
+    Answers /series: the rates of every region for every month between two dates.
+    """
+
+    variable = _parameter(query, "variable", "Inflation")
+    if variable not in ("Unemployment", "Inflation"):
+        raise RequestError(400, f"Invalid variable {variable!r}. Please choose either 'Unemployment' or 'Inflation'.")
+    horizon = _parameter(query, "horizon", "Year over year")
+
+    table = rpc.get_lookup_table(variable, horizon)
+    dates, values = rpc.lookup_regional_range(variable, _parameter(query, "start", table["dates"][0]), _parameter(query, "end", table["dates"][-1]), horizon)
+
+    return {
+        "variable": variable,
+        "horizon": horizon if variable == "Inflation" else None,
+        "dates": list(dates),
+        "values": {region: values[:, index] for index, region in enumerate(table["regions"])},
+    }
+
+
+async def _regression(query, executor):
+    """
+    Answers /regression: the same numbers as main_function (numeric_only) for a specification. The fit runs in the worker pool so the event
+    loop keeps answering other requests, and the response is kept for the next identical request until the data changes.
+    """
+
+    specification = rg.normalize_specification(
+        [_parameter(query, "start"), _parameter(query, "end")],
+        _parameter(query, "lag", "No lag"),
+        _parameter(query, "fit", "No Transformation"),
+        _parameter(query, "leverage", "Leave leverage points in dataset"),
+    )
+    key = (specification, rpc.get_data_version())
+
+    with _response_cache_lock:
+        if key in _response_cache:
+            _response_cache.move_to_end(key)
+            return _response_cache[key]
+
+    start, end, type_of_regression, type_of_fit, leverage = specification
+    output_mapping, removed = await asyncio.get_running_loop().run_in_executor(executor, _fit, [start, end], type_of_regression, type_of_fit, leverage)
+
+    payload = {
+        "specification": {"start": start, "end": end, "lag": type_of_regression, "fit": type_of_fit, "leverage": leverage},
+        "regions": output_mapping,
+        "removed": removed,
+    }
+
+    with _response_cache_lock:
+        _response_cache[key] = payload
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last = False)
+
+    return payload
+
+
+async def handle_request(method, target, executor):
+    """
+    This function answers one request of the API. Every answer is json.
+
+    GET /health - the status of the server and the version of the data
+
+    GET /regions - the names of the regions
+
+    GET /unemployment?date=yyyy-mm-01 - the unemployment rate of every region for a date
+
+    GET /inflation?date=yyyy-mm-01[&horizon=...] - the inflation rate of every region for a date (the horizon is one of rpc.INFLATION_HORIZONS)
+
+    GET /series?variable=Inflation|Unemployment[&start=...][&end=...][&horizon=...] - the rates of every region for every month of a range
+
+    GET /regression?start=...&end=...[&lag=...][&fit=...][&leverage=...] - the results of main_function for a specification, with the same
+    options as the dashboard (the lag defaults to "No lag", the fit to "No Transformation" and the leverage points are left in by default)
+
+    Inputs:
+
+    method - the HTTP method of the request
+
+    target - the path and query of the request
+
+    executor - the worker pool the regressions run in
+
+    Outputs: A tuple of the HTTP status and the payload
+    """
+
+    if method != "GET":
+        raise RequestError(405, f"Method {method} is not allowed, the API only answers GET requests.")
+
+    url = urlsplit(target)
+    query = parse_qs(url.query)
+
+    if url.path == "/health":
+        return 200, {"status": "ok", "data_version": rpc.get_data_version()}
+    if url.path == "/regions":
+        return 200, {"regions": rpc.get_regions()}
+    if url.path == "/unemployment":
+        return 200, _regional_values("Unemployment", query)
+    if url.path == "/inflation":
+        return 200, _regional_values("Inflation", query)
+    if url.path == "/series":
+        return 200, _series(query)
+    if url.path == "/regression":
+        return 200, await _regression(query, executor)
+
+    raise RequestError(404, f"Unknown path {url.path!r}.")
+
+
+def _response(status, payload, keep_alive):
+    """
+    Encodes a response as the bytes of an HTTP/1.1 message with a json body.
+    """
+
+    body = json.dumps(_clean(payload)).encode()
+    head = (f"HTTP/1.1 {status} {_STATUS_TEXT[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+
+    return head.encode() + body
+
+
+async def _serve_connection(reader, writer, executor):
+    """
+    Answers the requests of one connection, one after the other, until the client closes it or asks for it to be closed.
+    """
+
+    try:
+        while True:
+            # A line longer than the limit of the stream (MAX_LINE_BYTES, see start_api) or a Content-Length that isn't a number raises a
+            # ValueError, which is answered with a 400 like any other malformed request rather than dropping the connection without a reply
+            try:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                if len(request_line) > MAX_LINE_BYTES:
+                    raise RequestError(400, "The request line is too long.")
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    raise RequestError(400, "Malformed request line.")
+                method, target, version = parts
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # The API has no request bodies, but one that is sent anyway is read so the next request on the connection starts in the right place
+                length = int(headers.get("content-length", 0))
+                if length < 0:
+                    raise RequestError(400, "Invalid Content-Length.")
+                if length:
+                    await reader.readexactly(length)
+            except RequestError as error:
+                writer.write(_response(error.status, {"error": str(error)}, False))
+                await writer.drain()
+                break
+            except ValueError:
+                writer.write(_response(400, {"error": "A line of the request is too long or the request headers are malformed."}, False))
+                await writer.drain()
+                break
+
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+            try:
+                status, payload = await handle_request(method, target, executor)
+            except RequestError as error:
+                status, payload = error.status, {"error": str(error)}
+            except ValueError as error:
+                status, payload = 400, {"error": str(error)}
+            except Exception as error:
+                status, payload = 500, {"error": f"{type(error).__name__}: {error}"}
+
+            writer.write(_response(status, payload, keep_alive))
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_api(host = "127.0.0.1", port = 8765, workers = None):
+    """
+    This function starts the API server on the running event loop. The datasets are loaded into memory before the server starts listening,
+    every request is answered from them, and the regressions are fit in a pool of worker processes (each of which loads the datasets once when
+    it starts) so a slow fit never holds up the other requests.
+
+    Inputs:
+
+    host, port - the address to listen on (port 0 picks a free port)
+
+    workers - the number of worker processes for the regressions (defaults to the number of cores)
+
+    Outputs: A tuple of the asyncio server and the worker pool (shut the pool down after closing the server)
+    """
+
+    _load_worker()
+
+    executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_load_worker)
+
+    # The pool only forks its workers when it gets its first job. Starting them before the server listens keeps them from inheriting the
+    # socket of a connection, which would stay open after the server closes it, so a client reading until the end would never finish.
+    executor.submit(os.getpid).result()
+
+    # The limit of the stream is what readline allows, so a line over MAX_LINE_BYTES is answered with a 400 before it is all buffered
+    server = await asyncio.start_server(lambda reader, writer: _serve_connection(reader, writer, executor), host, port, limit=MAX_LINE_BYTES)
+
+    return server, executor
+
+
+async def serve(host = "127.0.0.1", port = 8765, workers = None):
+    """
+    Runs the API server until the process is stopped.
+    """
+
+    server, executor = await start_api(host, port, workers)
+    address = server.sockets[0].getsockname()
+    print(f"Serving the Regional Phillips Curve API on http://{address[0]}:{address[1]}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def main():
+    """
+    Command line entry point of the API server.
+    """
+
+    parser = argparse.ArgumentParser(description="Serve the regional data and the regression results as json over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--workers", type=int, help="number of worker processes for the regressions (defaults to the number of cores)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import RegionalPhillipsCurve as rpc
+import DataVisualizations as dv
+import Regression as rg
+import SpecificationSweep as ss
+
+# The file formats the figures can be written in
+FORMATS = ["png", "svg"]
+
+# The most maps handed to a worker at a time
+MAP_CHUNK_SIZE = 25
+
+
+def _slug(text):
+    """
+    Turns a label (a date, a region or an option of the dashboard) into something that can be used in a file name.
+    """
+
+    return re.sub(r'[^A-Za-z0-9]+', '-', str(text)).strip('-').lower()
+
+
+def _load_worker():
+    """
+    Runs once in every worker process before it gets any work: the datasets, their lookup tables and the simplified region geometry are
+    loaded here so that every map and regression the worker renders afterwards reuses them.
+    """
+
+    rpc.get_lookup_table("Unemployment")
+    rpc.get_lookup_table("Inflation")
+    dv.get_region_geometry(persist = True)
+
+
+def _save_figure(figure, path, formats):
+    """
+    Writes a figure in every requested format and lets go of it.
+
+    Outputs: The list of files that were written
+    """
+
+    written = []
+    for file_format in formats:
+        figure.savefig(f"{path}.{file_format}", format = file_format, dpi = dv.MAP_DPI, bbox_inches = 'tight')
+        written.append(f"{path}.{file_format}")
+    figure.clear()
+
+    return written
+
+
+def _render_maps(variable, dates, output_directory, formats, style):
+    """
+    Renders the maps of one variable for a chunk of dates inside a worker process.
+
+    Outputs: The list of files that were written
+    """
+
+    draw = dv.output_spatial_unemployment if variable == "Unemployment" else dv.output_spatial_inflation
+    directory = os.path.join(output_directory, "maps", _slug(variable))
+    os.makedirs(directory, exist_ok = True)
+
+    written = []
+    for date in dates:
+        written.extend(_save_figure(draw(date, cmap = style), os.path.join(directory, date), formats))
+
+    return written
+
+
+def _render_regressions(time_period, type_of_regression, type_of_fit, leverage, output_directory, formats):
+    """
+    Fits one regression specification inside a worker process and renders the plot of every region.
+
+    Outputs: A tuple of the rows of the summary (one per region) and the list of files that were written
+    """
+
+    output_mapping, removed = rg.main_function(time_period, type_of_regression, type_of_fit, leverage)
+
+    directory = os.path.join(output_directory, "regressions", "_".join(_slug(part) for part in [*time_period, type_of_regression, type_of_fit, leverage]))
+    os.makedirs(directory, exist_ok = True)
+
+    rows = []
+    written = []
+    for region, result in output_mapping.items():
+        written.extend(_save_figure(result.figure, os.path.join(directory, _slug(region)), formats))
+        result.close()
+
+        rows.append({
+            "start": time_period[0],
+            "end": time_period[1],
+            "lag": type_of_regression,
+            "transform": type_of_fit,
+            "leverage": leverage,
+            "region": region,
+            "r2": result.r2,
+            "intercept": result.intercept,
+            "slope": result.slope,
+            "coefficients": result.coefficients,
+            "n": len(result.y_data),
+            "removed": len(removed[region]) if removed else 0,
+        })
+
+    return rows, written
+
+
+def generate_report(output_directory, grid, variables = ("Unemployment", "Inflation"), dates = None, formats = ("png",), style = 'coolwarm', workers = None):
+    """
+    This function writes the whole report to disk without Streamlit: the spatial map of every variable for every date, the regression plot of
+    every region for every specification in the grid, and a summary of the coefficients as csv and json. The rendering is spread over a pool
+    of worker processes, each of which loads the data and the geometry once when it starts.
+
+    Inputs:
+
+    output_directory - The folder the report is written to. The maps go in maps/<variable>/<date>.<format>, the regression plots in
+    regressions/<specification>/<region>.<format>, and the summary in summary.csv and summary.json.
+
+    grid - A list of regression specifications as returned by SpecificationSweep.build_grid (it can be empty)
+
+    variables - The variables to draw maps of ("Unemployment" and/or "Inflation")
+
+    dates - The dates to draw maps for, as Strings or datetimes (defaults to every date with data for the variable)
+
+    formats - The formats to write every figure in (from FORMATS)
+
+    style - The matplotlib colormap of the maps
+
+    workers - The number of worker processes (defaults to the number of cores). With 1 everything runs in this process.
+
+    Outputs: A dictionary with the number of maps ("maps") and regression plots ("regressions") written and the summary as a pandas dataframe ("summary")
+    """
+
+    if not formats:
+        raise ValueError(f"No format was given. Please choose at least one of: {', '.join(FORMATS)}.")
+    for file_format in formats:
+        if file_format not in FORMATS:
+            raise ValueError(f"Invalid format {file_format!r}. Please choose from: {', '.join(FORMATS)}.")
+
+    os.makedirs(output_directory, exist_ok = True)
+
+    # The dates of the lookup tables are yyyy-mm-dd Strings, so the requested dates (Strings, datetimes or Timestamps) are put in that form
+    wanted = None if dates is None else {pd.to_datetime(date).strftime('%Y-%m-%d') for date in dates}
+
+    map_jobs = []
+    for variable in variables:
+        available = rpc.get_lookup_table(variable)["dates"]
+        variable_dates = [date for date in available if wanted is None or date in wanted]
+        for first in range(0, len(variable_dates), MAP_CHUNK_SIZE):
+            map_jobs.append((variable, variable_dates[first:first + MAP_CHUNK_SIZE], output_directory, list(formats), style))
+
+    regression_jobs = [(time_period, lag, fit, leverage, output_directory, list(formats)) for time_period, lag, fit, leverage in grid]
+
+    workers = workers or os.cpu_count()
+
+    if workers == 1:
+        _load_worker()
+        map_results = [_render_maps(*job) for job in map_jobs]
+        regression_results = [_render_regressions(*job) for job in regression_jobs]
+    else:
+        # The geometry sidecar is written here before the workers start, so they only ever read a finished file
+        dv.get_region_geometry(persist = True)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_load_worker) as executor:
+            map_futures = [executor.submit(_render_maps, *job) for job in map_jobs]
+            regression_futures = [executor.submit(_render_regressions, *job) for job in regression_jobs]
+            map_results = [future.result() for future in map_futures]
+            regression_results = [future.result() for future in regression_futures]
+
+    summary = pd.DataFrame([row for rows, _ in regression_results for row in rows])
+
+    # The csv gets one column per lag coefficient, while the json keeps them as a list
+    with open(os.path.join(output_directory, "summary.json"), 'w') as file:
+        json.dump(summary.to_dict(orient='records'), file, indent = 2)
+
+    if not summary.empty:
+        coefficients = pd.DataFrame(summary["coefficients"].tolist()).add_prefix("coefficient_lag_")
+        summary_table = pd.concat([summary.drop(columns=["coefficients"]), coefficients], axis=1)
+    else:
+        summary_table = summary
+    summary_table.to_csv(os.path.join(output_directory, "summary.csv"), index=False)
+
+    return {
+        "maps": sum(len(files) for files in map_results) // len(formats),
+        "regressions": sum(len(files) for _, files in regression_results) // len(formats),
+        "summary": summary,
+    }
+
+
+def main():
+    """
+    Command line entry point for the batch report. By default every map is drawn and the regressions are fit over the whole history of the
+    data with no lag, no transformation and every leverage point left in.
+    """
+
+    parser = argparse.ArgumentParser(description="Write the maps, regression plots and a summary of the coefficients to disk.")
+    parser.add_argument("--output", default="report", help="folder to write the report to")
+    parser.add_argument("--variables", nargs="*", choices=["Unemployment", "Inflation"], default=["Unemployment", "Inflation"], help="variables to draw maps of (none to skip the maps)")
+    parser.add_argument("--dates", nargs="+", help="dates to draw maps for in yyyy-mm-01 format (defaults to every date)")
+    parser.add_argument("--time-periods", nargs="*", help="time periods of the regressions as start:end (none to skip the regressions)")
+    parser.add_argument("--lags", nargs="+", choices=list(rg.LAGS), default=["No lag"], help="types of regression")
+    parser.add_argument("--transforms", nargs="+", choices=rg.FIT_OPTIONS, default=["No Transformation"], help="types of fit")
+    parser.add_argument("--leverage", nargs="+", choices=rg.LEVERAGE_OPTIONS, default=["Leave leverage points in dataset"], help="ways to handle leverage points")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=["png"], help="file formats of the figures")
+    parser.add_argument("--style", default="coolwarm", help="matplotlib colormap of the maps")
+    parser.add_argument("--workers", type=int, help="number of worker processes (defaults to the number of cores)")
+    args = parser.parse_args()
+
+    if args.time_periods is None:
+        dates = rpc.get_lookup_table("Inflation")["dates"]
+        time_periods = [[dates[0], dates[-1]]]
+    else:
+        time_periods = [time_period.split(":") for time_period in args.time_periods]
+
+    grid = ss.build_grid(time_periods, args.lags, args.transforms, args.leverage)
+    report = generate_report(args.output, grid, args.variables, args.dates, args.formats, args.style, args.workers)
+
+    print(f"Wrote {report['maps']} maps, {report['regressions']} regression plots and a summary of {len(report['summary'])} regional regressions to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import RegionalPhillipsCurve as rpc
+import Regression as rg
+
+# The regions of the real data, used for the synthetic datasets with 4 regions so that the maps can be drawn for them too
+REAL_REGIONS = ["Midwest Region", "Northeast Region", "South Region", "West Region"]
+
+# The dates are parsed into pandas timestamps, which only go from 1677 to 2262, so this is the longest history a synthetic dataset can have
+MAX_SYNTHETIC_MONTHS = 7000
+
+# How much slower (as a fraction of the baseline) a benchmark has to get before compare_results reports it as a regression
+DEFAULT_TOLERANCE = 0.10
+
+
+def generate_synthetic_data(directory, months, regions, seed = 0):
+    """
+    This function writes a synthetic pair of csv files laid out exactly like the real ones, for benchmarking at other scales. The CPI of every
+    region is a random walk with drift in logs (about 3% inflation a year) and the unemployment rate is an AR(1) process around 5.5%, so the
+    regressions fit on it look like the real thing.
+
+    Inputs:
+
+    directory - The folder the two csv files are written to
+
+    months - The number of months of data (at most MAX_SYNTHETIC_MONTHS). The data ends in June 2024 if that leaves enough room before it.
+
+    regions - The number of regions. With 4 the real region names are used, otherwise the regions are named "Region 1", "Region 2" and so on.
+
+    seed - The seed of the random numbers
+
+    Outputs: A tuple with the paths of the CPI csv file and the unemployment csv file
+    """
+
+    if not 13 <= months <= MAX_SYNTHETIC_MONTHS:
+        raise ValueError(f"The number of months must be between 13 and {MAX_SYNTHETIC_MONTHS}.")
+
+    rng = np.random.default_rng(seed)
+    names = REAL_REGIONS if regions == 4 else [f"Region {index + 1}" for index in range(regions)]
+
+    # Ending in June 2024 like the real data, unless the history is so long that it has to start at the first month pandas can represent
+    start = max(pd.Timestamp("2024-06-01") - pd.DateOffset(months = months - 1), pd.Timestamp("1678-01-01"))
+    dates = pd.date_range(start, periods = months, freq = 'MS').strftime('%Y-%m-%d')
+
+    cpi = 100 * np.exp(np.cumsum(rng.normal(0.0025, 0.002, size = (months, regions)), axis = 0))
+
+    unemployment = np.empty((months, regions))
+    unemployment[0] = rng.uniform(4, 7, size = regions)
+    shocks = rng.normal(0, 0.15, size = (months, regions))
+    for month in range(1, months):
+        unemployment[month] = 5.5 + 0.97 * (unemployment[month - 1] - 5.5) + shocks[month]
+    unemployment = np.clip(unemployment, 1, None)
+
+    cpi_path = os.path.join(directory, os.path.basename(rpc.CPI_PATH))
+    unem_path = os.path.join(directory, os.path.basename(rpc.UNEM_PATH))
+
+    # Written with a byte order mark and the same number formats as the files from the source
+    for path, values, decimals in [(cpi_path, cpi, 3), (unem_path, unemployment, 1)]:
+        frame = pd.DataFrame(np.round(values, decimals), columns = names)
+        frame.insert(0, 'Time Period', dates)
+        frame.to_csv(path, index = False, float_format = f'%.{decimals}f', encoding = 'utf-8-sig')
+
+    return cpi_path, unem_path
+
+
+@contextlib.contextmanager
+def use_dataset(cpi_path, unem_path):
+    """
+    Points RegionalPhillipsCurve at another pair of csv files for the duration of a with block, starting from an empty dataset store and
+    result cache so that nothing from the previous dataset is timed, and puts the real paths back afterwards.
+    """
+
+    original_paths = (rpc.CPI_PATH, rpc.UNEM_PATH)
+    rpc.CPI_PATH, rpc.UNEM_PATH = cpi_path, unem_path
+    rpc.clear_dataset_store()
+    rg.clear_result_cache()
+
+    try:
+        yield
+    finally:
+        rpc.CPI_PATH, rpc.UNEM_PATH = original_paths
+        rpc.clear_dataset_store()
+        rg.clear_result_cache()
+
+
+def _benchmarks():
+    """
+    Returns the benchmarks as a dictionary that maps a name to a tuple of (setup, run, unit, needs the real regions). The setup runs before
+    every repeat and isn't timed. The run does the timed work and returns how many units it processed, which gives the throughput.
+    """
+
+    def nothing():
+        pass
+
+    def load_datasets():
+        rpc.get_cpi()
+        frame = rpc.get_unem()
+        return frame.shape[0] * (frame.shape[1] - 1)
+
+    def inflation():
+        frame = rpc.create_inflation()
+        return frame.shape[0] * (frame.shape[1] - 1)
+
+    def lookup(function, variable):
+        def run():
+            dates = rpc.get_lookup_table(variable)["dates"]
+            for date in dates:
+                function(date)
+            return len(dates)
+        return run
+
+    def full_period():
+        dates = rpc.get_lookup_table("Inflation")["dates"]
+        return [dates[0], dates[-1]]
+
+    def cleaning():
+        data_by_region, _ = rg.clean_data(full_period(), "2-lags", "No Transformation", "Omit leverage points from dataset")
+        return len(data_by_region)
+
+    def regressions():
+        output_mapping, _ = rg.main_function(full_period(), "2-lags", "No Transformation", "Omit leverage points from dataset", numeric_only=True)
+        return len(output_mapping)
+
+    def spatial(function):
+        def run():
+            # Imported here so the benchmarks that don't draw maps never load geopandas
+            import DataVisualizations as dv
+            draw = getattr(dv, function)
+            draw(rpc.get_lookup_table("Inflation")["dates"][-1]).clear()
+            return 1
+        return run
+
+    return {
+        "load_datasets": (rpc.clear_dataset_store, load_datasets, "cells", False),
+        "create_inflation": (nothing, inflation, "cells", False),
+        "output_regional_unemployment": (nothing, lookup(rpc.output_regional_unemployment, "Unemployment"), "lookups", False),
+        "output_regional_inflation": (nothing, lookup(rpc.output_regional_inflation, "Inflation"), "lookups", False),
+        "clean_data": (nothing, cleaning, "regions", False),
+        "main_function": (rg.clear_result_cache, regressions, "regions", False),
+        "output_spatial_unemployment": (nothing, spatial("output_spatial_unemployment"), "maps", True),
+        "output_spatial_inflation": (nothing, spatial("output_spatial_inflation"), "maps", True),
+    }
+
+
+def run_benchmark(setup, run, repeats = 5):
+    """
+    This function times one benchmark. It runs once untimed to warm up, then `repeats` more times with the wall time measured by
+    time.perf_counter, and once more under tracemalloc to measure the peak memory (tracemalloc slows the code down, so that run isn't timed).
+
+    Inputs:
+
+    setup - A function that is called before every run and isn't timed
+
+    run - A function that does the timed work and returns the number of units it processed
+
+    repeats - The number of timed runs
+
+    Outputs: A dictionary with the median and the fastest time in seconds ("median_seconds", "min_seconds"), the units processed per second
+    at the median time ("throughput") and the peak memory in bytes allocated during a run ("peak_memory_bytes")
+    """
+
+    setup()
+    units = run()
+
+    times = []
+    for _ in range(repeats):
+        setup()
+        start = time.perf_counter()
+        units = run()
+        times.append(time.perf_counter() - start)
+
+    setup()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(times)
+
+    return {
+        "median_seconds": median,
+        "min_seconds": min(times),
+        "throughput": units / median if median > 0 else float('inf'),
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_suite(scales = None, names = None, repeats = 5, include_real = True, seed = 0):
+    """
+    This function runs the benchmarks on the real data and on synthetic datasets of the requested sizes.
+
+    Inputs:
+
+    scales - A list of (months, regions) pairs, one synthetic dataset each (defaults to none)
+
+    names - The names of the benchmarks to run (defaults to all of them). The map benchmarks only run on datasets with the real regions.
+
+    repeats - The number of timed runs of every benchmark
+
+    include_real - Whether to run the benchmarks on the real data too
+
+    seed - The seed of the synthetic data
+
+    Outputs: A list of dictionaries, one per benchmark and dataset, with the name of the benchmark ("name"), the dataset ("dataset", "months",
+    "regions"), the unit of the throughput ("unit") and the timings returned by run_benchmark
+    """
+
+    benchmarks = _benchmarks()
+    names = names or list(benchmarks)
+
+    def run_all(dataset):
+        rows = []
+        unemployment = rpc.get_lookup_table("Unemployment")
+        real_regions = list(unemployment["regions"]) == REAL_REGIONS
+
+        for name in names:
+            setup, run, unit, needs_real_regions = benchmarks[name]
+            if needs_real_regions and not real_regions:
+                continue
+            row = {"name": name, "dataset": dataset, "months": len(unemployment["dates"]), "regions": len(unemployment["regions"]), "unit": unit}
+            row.update(run_benchmark(setup, run, repeats))
+            rows.append(row)
+        return rows
+
+    results = []
+
+    if include_real:
+        with use_dataset(rpc.CPI_PATH, rpc.UNEM_PATH):
+            results.extend(run_all("real"))
+
+    for months, regions in scales or []:
+        with tempfile.TemporaryDirectory() as directory:
+            with use_dataset(*generate_synthetic_data(directory, months, regions, seed)):
+                results.extend(run_all(f"synthetic-{months}x{regions}"))
+
+    return results
+
+
+def environment():
+    """
+    Returns a description of the machine and the code the benchmarks ran on, which is saved with the results so baselines from different
+    machines or commits aren't mistaken for each other.
+    """
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec = 'seconds'),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "system": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def save_results(results, path):
+    """
+    Writes benchmark results, together with the environment they ran in, to a json file that can be used as a baseline.
+    """
+
+    with open(path, 'w') as file:
+        json.dump({"environment": environment(), "results": results}, file, indent = 2)
+
+
+def load_results(path):
+    """
+    Reads benchmark results written by save_results.
+    """
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(baseline, current, tolerance = DEFAULT_TOLERANCE):
+    """
+    This function compares two sets of benchmark results (as returned by load_results) benchmark by benchmark, matching them on the name of
+    the benchmark and the dataset.
+
+    Inputs:
+
+    baseline - The results to compare against
+
+    current - The new results
+
+    tolerance - How much slower a benchmark may get, as a fraction of the baseline median time, before it counts as a regression
+
+    Outputs: A pandas dataframe with one row per benchmark that is in both sets of results and the columns name, dataset, baseline_seconds,
+    current_seconds, ratio (current / baseline median time), baseline_peak_bytes, current_peak_bytes and regression (True when the ratio is
+    above 1 + tolerance)
+    """
+
+    baseline_rows = {(row["name"], row["dataset"]): row for row in baseline["results"]}
+
+    rows = []
+    for row in current["results"]:
+        old = baseline_rows.get((row["name"], row["dataset"]))
+        if old is None:
+            continue
+        ratio = row["median_seconds"] / old["median_seconds"]
+        rows.append({
+            "name": row["name"],
+            "dataset": row["dataset"],
+            "baseline_seconds": old["median_seconds"],
+            "current_seconds": row["median_seconds"],
+            "ratio": ratio,
+            "baseline_peak_bytes": old["peak_memory_bytes"],
+            "current_peak_bytes": row["peak_memory_bytes"],
+            "regression": ratio > 1 + tolerance,
+        })
+
+    return pd.DataFrame(rows)
+
+
+# Run in a fresh interpreter by measure_startup, so nothing is imported or cached before the app starts. It prints the timings as json.
+_STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+app = AppTest.from_file("Streamlit.py", default_timeout=600)
+app.run()
+painted = time.perf_counter()
+heavy_modules = [name for name in ("geopandas", "shapely", "matplotlib", "sklearn") if name in sys.modules]
+app.run()
+rerun = time.perf_counter()
+app.button(key="tab 1").click().run()
+mapped = time.perf_counter()
+app.selectbox[3].set_value(app.selectbox[3].options[-1])
+app.button(key="tab 2").click().run()
+fitted = time.perf_counter()
+print(json.dumps({
+    "streamlit_import_seconds": imported - started,
+    "first_paint_seconds": painted - imported,
+    "rerun_seconds": rerun - painted,
+    "first_map_seconds": mapped - rerun,
+    "first_regression_seconds": fitted - mapped,
+    "heavy_modules_at_first_paint": heavy_modules,
+    "errors": [str(error.value) for error in app.exception],
+}))
+"""
+
+
+def measure_startup(repeats = 3, warm_up = False):
+    """
+    This function measures how long the Streamlit app takes to start. Every measurement runs the app with Streamlit's AppTest in a fresh
+    Python process, so the imports and the caches are as cold as on a newly started server. The headline number is the first paint: the time
+    from starting the script to the first page being fully drawn. The time of a rerun, of drawing the first map and of fitting the first
+    regression after that are measured too, along with the heavy modules that were loaded by the first paint.
+
+    Inputs:
+
+    repeats - The number of fresh processes to measure
+
+    warm_up - Whether the background warm-up of the app runs (see RPC_WARM_UP in Streamlit.py). It competes with the first map and
+    regression for the processor, so it is off by default.
+
+    Outputs: A dictionary with the median of every timing in seconds, the heavy modules loaded at the first paint and the number of processes measured
+    """
+
+    env = dict(os.environ, RPC_WARM_UP="1" if warm_up else "0", PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", _STARTUP_PROBE], capture_output = True, text = True, env = env, check = True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        if run["errors"]:
+            raise RuntimeError(f"The app failed while starting: {run['errors']}")
+        runs.append(run)
+
+    report = {name: statistics.median(run[name] for run in runs) for name in runs[0] if name.endswith("_seconds")}
+    report["heavy_modules_at_first_paint"] = runs[0]["heavy_modules_at_first_paint"]
+    report["processes"] = repeats
+
+    return report
+
+
+def main():
+    """
+    Command line entry point. `run` times the benchmarks and saves the results (optionally comparing them against a baseline), `compare`
+    compares two saved result files and `startup` measures the cold start of the Streamlit app. The exit code is 1 when a benchmark got
+    slower than the tolerance allows.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the regional Phillips curve analysis.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and save the results")
+    run_parser.add_argument("--months", nargs="+", type=int, default=[], help="months of synthetic data (every value is combined with every --regions value)")
+    run_parser.add_argument("--regions", nargs="+", type=int, default=[4], help="regions of synthetic data")
+    run_parser.add_argument("--benchmarks", nargs="+", choices=list(_benchmarks()), help="benchmarks to run (defaults to all of them)")
+    run_parser.add_argument("--repeats", type=int, default=5, help="number of timed runs of every benchmark")
+    run_parser.add_argument("--skip-real", action="store_true", help="only run on the synthetic data")
+    run_parser.add_argument("--output", default="benchmark_results.json", help="path of the json file to write the results to")
+    run_parser.add_argument("--baseline", help="json file of earlier results to compare against")
+    run_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown before a benchmark counts as a regression")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved result files")
+    compare_parser.add_argument("baseline", help="json file of the results to compare against")
+    compare_parser.add_argument("current", help="json file of the new results")
+    compare_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown before a benchmark counts as a regression")
+
+    startup_parser = subparsers.add_parser("startup", help="measure the cold start of the Streamlit app")
+    startup_parser.add_argument("--repeats", type=int, default=3, help="number of fresh processes to measure")
+    startup_parser.add_argument("--warm-up", action="store_true", help="let the background warm-up of the app run")
+
+    args = parser.parse_args()
+
+    if args.command == "startup":
+        report = measure_startup(args.repeats, args.warm_up)
+        print(f"First paint: {report['first_paint_seconds']:.2f}s")
+        for name, value in report.items():
+            if name.endswith("_seconds") and name != "first_paint_seconds":
+                print(f"  {name[:-len('_seconds')].replace('_', ' ')}: {value:.2f}s")
+        print(f"  heavy modules loaded at first paint: {', '.join(report['heavy_modules_at_first_paint']) or 'none'}")
+        return
+
+    if args.command == "run":
+        scales = [(months, regions) for months in args.months for regions in args.regions]
+        results = run_suite(scales, args.benchmarks, args.repeats, include_real=not args.skip_real)
+        save_results(results, args.output)
+
+        table = pd.DataFrame(results)[["name", "dataset", "median_seconds", "throughput", "unit", "peak_memory_bytes"]]
+        print(table.to_string(index=False))
+        print(f"Wrote the results to {args.output}")
+
+        if not args.baseline:
+            return
+        baseline, current = load_results(args.baseline), load_results(args.output)
+    else:
+        baseline, current = load_results(args.baseline), load_results(args.current)
+
+    comparison = compare_results(baseline, current, args.tolerance)
+    print(comparison.to_string(index=False))
+
+    if comparison["regression"].any():
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+#Folder the binary copies of the datasets are written to
+CACHE_DIRECTORY = 'data/cache'
+
+
+def _cache_paths(name):
+    """
+    Returns the paths of the three files that make up the binary copy of a table: the values, the dates and the metadata.
+    """
+
+    stem = os.path.join(CACHE_DIRECTORY, name)
+
+    return f"{stem}.values.npy", f"{stem}.dates.npy", f"{stem}.meta.json"
+
+
+def _signature(path):
+    """
+    Returns the (mtime, size) signature of a file as a list, so it can be stored as json.
+    """
+
+    stat = os.stat(path)
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def file_hash(path):
+    """
+    Returns the SHA-256 hash of the contents of a file.
+    """
+
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def has_table(name):
+    """
+    Returns whether a binary copy of a table has been written (fresh or not).
+    """
+
+    return os.path.exists(_cache_paths(name)[2])
+
+
+def save_table(name, dates, columns, values, source_path, source_hash = None):
+    """
+    This function writes a table of regional data in a binary, columnar layout: the values go in a memory-mappable .npy file of float64s
+    (one column per region), the dates go in their own .npy file, and a small json file records the column names and the signature and
+    hash of the csv file the table was built from, so that a stale copy is never read.
+
+    Inputs:
+
+    name - the name of the table (the file names are derived from it)
+
+    dates - the dates of the rows as Strings in yyyy-mm-dd format
+
+    columns - the names of the value columns
+
+    values - a 2-D array of shape (dates, columns)
+
+    source_path - the csv file the table was built from
+
+    source_hash - the SHA-256 hash of the csv file, if it is already known
+    """
+
+    os.makedirs(CACHE_DIRECTORY, exist_ok = True)
+    values_path, dates_path, meta_path = _cache_paths(name)
+
+    meta = {
+        "columns": list(columns),
+        "source": source_path,
+        "signature": _signature(source_path),
+        "hash": source_hash or file_hash(source_path),
+    }
+
+    #Writing every file next to its final path first and then moving it into place, so a reader never sees half of a file
+    np.save(values_path + ".tmp.npy", np.ascontiguousarray(values, dtype = np.float64))
+    np.save(dates_path + ".tmp.npy", np.asarray(dates, dtype = str))
+    with open(meta_path + ".tmp", 'w') as file:
+        json.dump(meta, file)
+
+    os.replace(values_path + ".tmp.npy", values_path)
+    os.replace(dates_path + ".tmp.npy", dates_path)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def load_table(name, source_path, source_hash = None):
+    """
+    This function reads the binary copy of a table if there is one and it is fresh. It is fresh when the csv file it was built from still
+    has the same mtime and size, or failing that, the same contents. The values are memory-mapped rather than read, so every process that
+    loads the table shares the same copy through the operating system's page cache.
+
+    Inputs:
+
+    name - the name of the table
+
+    source_path - the csv file the table was built from
+
+    source_hash - the SHA-256 hash of the csv file, if it is already known
+
+    Outputs: None if there is no fresh copy, otherwise a dictionary with the dates ("dates", an object array of Strings), the column names
+    ("columns"), the read-only memory-mapped values ("values") and the hash of the csv file ("hash")
+    """
+
+    values_path, dates_path, meta_path = _cache_paths(name)
+
+    try:
+        with open(meta_path) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    signature = _signature(source_path)
+
+    if meta["signature"] != signature:
+        #The csv was touched, so we only trust the copy if the contents are the same (and then record the new signature)
+        if (source_hash or file_hash(source_path)) != meta["hash"]:
+            return None
+        meta["signature"] = signature
+        with open(meta_path, 'w') as file:
+            json.dump(meta, file)
+
+    try:
+        values = np.load(values_path, mmap_mode = 'r')
+        dates = np.load(dates_path).astype(object)
+    except (OSError, ValueError):
+        return None
+
+    return {"dates": dates, "columns": meta["columns"], "values": values, "hash": meta["hash"]}
+
+
+def build_cache():
+    """
+    This function converts the CPI and unemployment csv files, and the inflation table for every horizon, into their binary copies. Run it
+    whenever the csv files change (a stale copy is simply ignored until then).
+
+    Outputs: A list with the names of the tables that were written
+    """
+
+    # Imported here since RegionalPhillipsCurve reads its data through this module
+    import RegionalPhillipsCurve as rpc
+
+    written = []
+
+    for path, frame in [(rpc.CPI_PATH, rpc.get_cpi()), (rpc.UNEM_PATH, rpc.get_unem())]:
+        name = rpc.dataset_cache_name(path)
+        save_table(name, frame.iloc[:, 0].to_numpy(), frame.columns[1:], frame.iloc[:, 1:].to_numpy(), path)
+        written.append(name)
+
+    for horizon in rpc.INFLATION_HORIZONS:
+        frame = rpc.create_inflation(horizon)
+        name = rpc.inflation_cache_name(horizon)
+        save_table(name, frame.iloc[:, 0].to_numpy(), frame.columns[1:], frame.iloc[:, 1:].to_numpy(), rpc.CPI_PATH)
+        written.append(name)
+
+    return written
+
+
+if __name__ == '__main__':
+    for table_name in build_cache():
+        print(f"Wrote {os.path.join(CACHE_DIRECTORY, table_name)}")
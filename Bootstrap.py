@@ -0,0 +1,170 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import Regression as rg
+from Instrumentation import instrumented
+
+# The kinds of bootstrap that can be used for the confidence intervals
+METHODS = ["pairs", "residual", "block"]
+
+# The most resamples drawn for a region in one batched solve, which keeps the resample count matrix to a few megabytes
+CHUNK_SIZE = 2500
+
+
+def resample_counts(rng, n, n_resamples, method, block_length = None):
+    """
+    This function draws the bootstrap resamples of n observations as a matrix of counts: entry (b, i) is how many times observation i appears
+    in resample b. Counting rather than gathering the rows means the resampled data is never built, the sums of every resample come from one
+    matrix product instead.
+
+    Inputs:
+
+    rng - A numpy random Generator
+
+    n - The number of observations
+
+    n_resamples - The number of resamples to draw
+
+    method - Either "pairs" (observations drawn one at a time) or "block" (a moving block bootstrap, where runs of block_length consecutive
+    observations are drawn so that the serial correlation inside a block is kept)
+
+    block_length - The length of the blocks of the block bootstrap (defaults to n^(1/3))
+
+    Outputs: A numpy array of shape (n_resamples, n) with the counts
+    """
+
+    if method == "block":
+        block_length = block_length or max(1, int(round(n ** (1 / 3))))
+        block_length = min(block_length, n)
+        n_blocks = -(-n // block_length)
+
+        # Every resample is made of n_blocks blocks with random starts, cut down to n observations
+        starts = rng.integers(0, n - block_length + 1, size = (n_resamples, n_blocks))
+        indices = (starts[:, :, None] + np.arange(block_length)).reshape(n_resamples, -1)[:, :n]
+    else:
+        indices = rng.integers(0, n, size = (n_resamples, n))
+
+    # Counting every (resample, observation) pair at once by giving every resample its own range of bins
+    offsets = np.arange(n_resamples)[:, None] * n
+    counts = np.bincount((indices + offsets).ravel(), minlength = n_resamples * n)
+
+    return counts.reshape(n_resamples, n).astype(np.float64)
+
+
+def _bootstrap_chunk(x_data, y_data, method, n_resamples, block_length, seed):
+    """
+    Draws one chunk of resamples for one region and solves all of them at once.
+
+    Inputs:
+
+    x_data - A 2-D numpy array (observations x regressors) with the x data of the region
+
+    y_data - A 1-D numpy array with the y data of the region
+
+    method, block_length - see bootstrap_confidence_intervals
+
+    n_resamples - The number of resamples in the chunk
+
+    seed - The numpy SeedSequence of the chunk
+
+    Outputs: A numpy array of shape (n_resamples, regressors + 1) with the intercept and the coefficients of every resample
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(y_data)
+    design = np.column_stack([np.ones(n), x_data])
+
+    xtx = design.T @ design
+    xtx_inverse = np.linalg.pinv(xtx, hermitian = True)
+
+    if method == "residual":
+        # The design stays fixed and only the residuals are resampled, so every resample is the original fit plus the fit of its resampled residuals
+        estimate = xtx_inverse @ design.T @ y_data
+        residuals = y_data - design @ estimate
+        indices = rng.integers(0, n, size = (n_resamples, n))
+        return estimate + residuals[indices] @ design @ xtx_inverse
+
+    counts = resample_counts(rng, n, n_resamples, method, block_length)
+
+    # The cross-product matrices of every resample are the counts times the cross products of every row, solved in one batched call
+    outer_products = (design[:, :, None] * design[:, None, :]).reshape(n, -1)
+    xtx_resampled = (counts @ outer_products).reshape(n_resamples, design.shape[1], design.shape[1])
+    xty_resampled = counts @ (design * y_data[:, None])
+
+    return np.einsum('bij,bj->bi', np.linalg.pinv(xtx_resampled, hermitian = True), xty_resampled)
+
+
+@instrumented()
+def bootstrap_confidence_intervals(time_period, type_of_regression, type_of_fit, leverage, method = "pairs", n_resamples = 2000, confidence = 0.95,
+                                   block_length = None, seed = 0, workers = 1):
+    """
+    This function puts bootstrap confidence intervals around the intercept, the lag coefficients and the long-run slope (the sum of the lag
+    coefficients) of every region, for the same specification as main_function (the cleaned data comes from the regression result cache). The
+    resamples of a region are solved together in a few batched chunks, and with more than one worker the chunks of all of the regions are
+    spread over a pool of processes. Every chunk gets its own seed spawned from the seed passed in, so the intervals are the same for the same
+    seed no matter how many workers are used.
+
+    Inputs:
+
+    time_period, type_of_regression, type_of_fit, leverage - the specification, the same as main_function
+
+    method - A string from METHODS: "pairs" resamples (unemployment, inflation) observations, "residual" keeps the unemployment data and
+    resamples the residuals of the fit, and "block" resamples runs of consecutive months so that serial correlation is kept
+
+    n_resamples - The number of bootstrap resamples per region
+
+    confidence - The confidence level of the (percentile) intervals
+
+    block_length - The number of months in a block of the block bootstrap (defaults to the cube root of the number of observations)
+
+    seed - The seed of the random numbers
+
+    workers - The number of worker processes. With 1 (the default) everything runs in this process, which is the fastest for a single
+    specification since starting the pool costs more than the resamples do.
+
+    Outputs:
+    A dictionary that maps a region to a dictionary with the keys "intercept", "coefficients" and "slope". The values are [lower, upper] lists
+    for the intercept and the slope and a list of [lower, upper] lists (one per lag) for the coefficients.
+    """
+
+    if method not in METHODS:
+        raise ValueError(f"Invalid bootstrap method {method!r}. Please choose one of: {', '.join(METHODS)}.")
+    if not 0 < confidence < 1:
+        raise ValueError("The confidence level must be between 0 and 1.")
+
+    results = rg.fit_specification(time_period, type_of_regression, type_of_fit, leverage)
+    regions = list(results["regions"])
+
+    # Splitting the resamples of every region into chunks, each with its own seed
+    chunk_sizes = [min(CHUNK_SIZE, n_resamples - first) for first in range(0, n_resamples, CHUNK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(regions) * len(chunk_sizes))
+
+    tasks = []
+    for index, region in enumerate(regions):
+        x_data, y_data, _ = results["regions"][region]
+        for chunk, size in enumerate(chunk_sizes):
+            tasks.append((x_data, y_data, method, size, block_length, seeds[index * len(chunk_sizes) + chunk]))
+
+    if workers == 1:
+        draws = [_bootstrap_chunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            draws = list(executor.map(_bootstrap_chunk, *zip(*tasks)))
+
+    tail = (1 - confidence) / 2 * 100
+
+    output_mapping = {}
+    for index, region in enumerate(regions):
+        region_draws = np.concatenate(draws[index * len(chunk_sizes):(index + 1) * len(chunk_sizes)])
+        slopes = region_draws[:, 1:].sum(axis = 1)
+
+        lower, upper = np.percentile(region_draws, [tail, 100 - tail], axis = 0)
+        slope_lower, slope_upper = np.percentile(slopes, [tail, 100 - tail])
+
+        output_mapping[region] = {
+            "intercept": [float(lower[0]), float(upper[0])],
+            "coefficients": [[float(low), float(high)] for low, high in zip(lower[1:], upper[1:])],
+            "slope": [float(slope_lower), float(slope_upper)],
+        }
+
+    return output_mapping
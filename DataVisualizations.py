@@ -1,97 +1,473 @@
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
 import geopandas as gpd
-import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from matplotlib import animation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
 import RegionalPhillipsCurve as rpc
+from Instrumentation import instrumented, span
 
+#Path to the shapefile of the US Census Bureau regions, the column holding the name every region is joined to the data by, and what the
+#regions are called in the titles of the maps. Point these at another shapefile (states, metro areas) to map other regions.
+SHAPEFILE_PATH = "cb_2018_us_region_500k/cb_2018_us_region_500k.shp"
+GEOMETRY_NAME_COLUMN = 'NAME'
+REGION_LABEL = 'US Census Bureau Region'
 
+#Above this many regions the values aren't written on the map, since the labels would cover it
+MAX_LABELED_REGIONS = 60
 
-def output_spatial_unemployment(date):
+#The maps always show the same longitude and latitude bounds
+MAP_BOUNDS = (-125, 25, -66, 50)
+
+#Default simplification tolerance in degrees. The viewport is 59 degrees wide on a 10 inch figure, so at 100 dpi one pixel is roughly
+#0.06 degrees and anything finer than a third of a pixel can't be seen
+DEFAULT_TOLERANCE = 0.02
+
+#Upper limit on the total size of the PNG bytes kept in the rendered map cache, and the resolution the maps are rendered at
+MAP_CACHE_MAX_BYTES = 128 * 1024 * 1024
+MAP_DPI = 150
+
+#Cache of the region geometry, maps (shapefile, tolerance) to a GeoDataFrame sorted by region name (a tolerance of None is the full resolution shapefile)
+_geometry_cache = {}
+
+
+def _sidecar_path(tolerance):
     """
-    This function creates a spatial plot of the unemployment rate for a given date. It uses the RegionalPhillipsCurve module to get 
-    the unemployment rate for each region in the US and puts it on a heatmap using geopandas and matplotlib.
+    Returns the path of the GeoParquet sidecar file that stores the region geometry simplified to the given tolerance.
+    """
+
+    return f"{os.path.splitext(SHAPEFILE_PATH)[0]}.simplified-{tolerance}.parquet"
+
+
+@instrumented()
+def get_region_geometry(tolerance = DEFAULT_TOLERANCE, persist = False):
+    """
+    This function returns the region geometry of SHAPEFILE_PATH (the US Census Bureau regions by default) sorted by name (so the regions are in alphabetical order). The shapefile is
+    only parsed once per process and every simplified version is kept in memory after it is first built. The simplified geometry is
+    clipped to the bounds of the map, since nothing outside of them is ever drawn.
+
+    Inputs:
+
+    tolerance - the simplification tolerance in degrees, or None for the full resolution geometry
 
-    Inputs: date - a string in the format 'YYYY-MM-DD'
+    persist - whether to read and write the simplified geometry from a GeoParquet sidecar file next to the shapefile, so that later
+    processes can skip parsing and simplifying the shapefile
 
-    Outputs: A matplotlib plot of the unemployment rate for each region in the US.
+    Outputs: A GeoDataFrame from geopandas with one row per region. It is a copy, so columns can be added to it freely.
     """
 
-    #Getting the shape of the US Census Bureau regions for the US
-    shapefile_path = "cb_2018_us_region_500k/cb_2018_us_region_500k.shp"
+    #The cache is keyed on the shapefile too, so pointing SHAPEFILE_PATH at other regions never serves the old geometry
+    key = (SHAPEFILE_PATH, tolerance)
+    full_key = (SHAPEFILE_PATH, None)
 
-    #Reading the file using geopandas read_file function and then sorting the regions so that they are in alphabetical order
-    gdf = gpd.read_file(shapefile_path).sort_values(by = 'NAME')
+    if key in _geometry_cache:
+        return _geometry_cache[key].copy()
 
-    unemployment_rates = rpc.output_regional_unemployment(date)
+    sidecar = _sidecar_path(tolerance) if tolerance is not None else None
+
+    #Using the sidecar file if it was written after the shapefile was last changed
+    if persist and sidecar is not None and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(SHAPEFILE_PATH):
+        _geometry_cache[key] = gpd.read_parquet(sidecar)
+        return _geometry_cache[key].copy()
+
+    if full_key not in _geometry_cache:
+        #Reading the file using geopandas read_file function and then sorting the regions so that they are in alphabetical order
+        _geometry_cache[full_key] = gpd.read_file(SHAPEFILE_PATH).sort_values(by = GEOMETRY_NAME_COLUMN).reset_index(drop = True)
+
+    if tolerance is None:
+        return _geometry_cache[full_key].copy()
+
+    gdf = _geometry_cache[full_key].copy()
+    gdf['geometry'] = gdf.simplify(tolerance, preserve_topology = True)
+
+    #Clipping with a small margin around the map bounds so the polygon edges are never visible
+    min_x, min_y, max_x, max_y = MAP_BOUNDS
+    gdf = gdf.clip((min_x - 1, min_y - 1, max_x + 1, max_y + 1)).sort_values(by = GEOMETRY_NAME_COLUMN).reset_index(drop = True)
+
+    if persist:
+        #Writing next to the sidecar first and then moving it into place, so a process reading it at the same time never sees half of the file
+        temporary = f"{sidecar}.{os.getpid()}.tmp"
+        gdf.to_parquet(temporary)
+        os.replace(temporary, sidecar)
+
+    _geometry_cache[key] = gdf
+
+    return gdf.copy()
+
+
+
+def region_key(name):
+    """
+    Normalizes the name of a region so the data can be joined to the geometry by name: the csv files call a region "Midwest Region" while
+    the shapefile calls it "Midwest", and both become "midwest".
+    """
 
-    gdf['Unemployment Rate'] = unemployment_rates
+    name = str(name).strip().lower()
+
+    return name[:-len(" region")] if name.endswith(" region") else name
+
+
+def join_region_values(gdf, regions, values, column):
+    """
+    This function adds the values of every region in the data to the geometry, matching the regions by name (see region_key) rather than by
+    position, so any set of regions (census regions, states, metro areas) can be mapped as long as the shapefile has a region of the same name.
+
+    Inputs:
+
+    gdf - A GeoDataFrame with the names of the regions in the GEOMETRY_NAME_COLUMN column
+
+    regions - The names of the regions in the data
+
+    values - The value of every region, in the same order as regions
+
+    column - The name of the column the values are stored in
+
+    Outputs: The GeoDataFrame with the new column. Regions without data get NaN, and data for regions without geometry is left out.
+    """
+
+    values_by_key = dict(zip((region_key(region) for region in regions), values))
+    gdf[column] = [values_by_key.get(region_key(name), np.nan) for name in gdf[GEOMETRY_NAME_COLUMN]]
+
+    return gdf
+
+
+def label_points(gdf):
+    """
+    Returns the points the value labels of the regions are drawn at: the centroid of every region, or a point guaranteed to be inside the
+    region when the centroid falls outside of it (which happens for crescent-shaped regions).
+
+    Inputs: gdf - A GeoDataFrame of the regions
+
+    Outputs: A numpy array of shape (regions, 2) with the longitude and latitude of every label
+    """
+
+    geometry = np.asarray(gdf.geometry)
+
+    # Working on the shapely geometries directly, since the centroids are only used to place labels on the map (geopandas warns about
+    # centroids in longitude and latitude)
+    centroids = shapely.centroid(geometry)
+    points = np.where(shapely.within(centroids, geometry), centroids, shapely.point_on_surface(geometry))
+
+    return np.column_stack([shapely.get_x(points), shapely.get_y(points)])
+
+
+@instrumented("DataVisualizations.draw_spatial_map")
+def _draw_spatial_map(variable, date, cmap):
+    """
+    Draws the heatmap of unemployment or inflation for a date, with the value of every region written on it. The regions come from the
+    data and are joined to the geometry by name, and the labels are placed at the centroids of the regions.
 
-    # Create a plot using matplotlib subplots function
-    fig, ax = plt.subplots(figsize=(10, 10))
+    Inputs:
 
-    # Plot the GeoDataFrame using geopandas plot function
-    gdf.plot(ax=ax, edgecolor='black', column='Unemployment Rate', cmap='coolwarm', legend=True)
+    variable - a string that is either "Unemployment" or "Inflation"
 
-    #Setting the coordinates where unemployment rates will be displayed manually (indexing into the unemployment_rates list)
-    ax.text(-93, 42, f"{unemployment_rates[0]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting Midwest
-    ax.text(-74, 42.5, f"{unemployment_rates[1]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting Northeast
-    ax.text(-90, 33, f"{unemployment_rates[2]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting South
-    ax.text(-112, 40, f"{unemployment_rates[3]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting West
+    date - a string in the format 'YYYY-MM-01'
 
-    ax.set_xlim(-125, -66)  # Longitude bounds
-    ax.set_ylim(25, 50) # Latitude bounds
+    cmap - the name of the matplotlib colormap used for the heatmap
+
+    Outputs: A matplotlib figure (a ValueError is raised if there is no data for the date)
+    """
+
+    #Getting the shape of the regions (parsed once and simplified for the map bounds)
+    gdf = get_region_geometry()
+
+    if variable == "Unemployment":
+        rates = rpc.output_regional_unemployment(date)
+    else:
+        rates = rpc.output_regional_inflation(date)
+
+    #An invalid date gives back an error message instead of the rates
+    if isinstance(rates, str):
+        raise ValueError(rates)
+
+    column = f"{variable} Rate"
+    #The rates come in the column order of the variable's own csv file, which doesn't have to match the other file
+    gdf = join_region_values(gdf, rpc.get_lookup_table(variable)["regions"], rates, column)
+
+    # Create the figure directly rather than through pyplot, so it isn't kept alive by pyplot and can be drawn from any thread
+    fig = Figure(figsize=(10, 10))
+    ax = fig.subplots()
+
+    # Plot the GeoDataFrame using geopandas plot function (regions without data are drawn in grey)
+    gdf.plot(ax=ax, edgecolor='black', column=column, cmap=cmap, legend=True, missing_kwds={'color': 'lightgrey'})
+
+    #Writing the rate of every region at its centroid, unless there are too many regions for the labels to be readable
+    labeled = gdf[column].notna().to_numpy()
+    if labeled.sum() <= MAX_LABELED_REGIONS:
+        for (x, y), rate in zip(label_points(gdf[labeled]), gdf.loc[labeled, column]):
+            ax.text(x, y, f"{rate}%", fontsize=10, ha='center', fontweight = 'bold')
+
+    ax.set_xlim(MAP_BOUNDS[0], MAP_BOUNDS[2])  # Longitude bounds
+    ax.set_ylim(MAP_BOUNDS[1], MAP_BOUNDS[3]) # Latitude bounds
 
     # Set plot title and labels
-    ax.set_title('Unemployment Rates by US Census Bureau Region for ' + date, fontweight = 'bold')
+    ax.set_title(f'{variable} Rates by {REGION_LABEL} for ' + date, fontweight = 'bold')
     ax.set_xlabel('Longitude', fontweight = 'bold')
     ax.set_ylabel('Latitude', fontweight = 'bold')
 
     return fig
 
 
+def output_spatial_unemployment(date, cmap = 'coolwarm'):
+    """
+    This function creates a spatial plot of the unemployment rate for a given date. It uses the RegionalPhillipsCurve module to get 
+    the unemployment rate for each region in the data and puts it on a heatmap using geopandas and matplotlib.
+
+    Inputs:
 
-def output_spatial_inflation(date):
+    date - a string in the format 'YYYY-MM-DD'
+
+    cmap - the name of the matplotlib colormap used for the heatmap
+
+    Outputs: A matplotlib plot of the unemployment rate for each region.
+    """
+
+    return _draw_spatial_map("Unemployment", date, cmap)
+
+
+
+def output_spatial_inflation(date, cmap = 'coolwarm'):
     """
     This function creates a spatial plot of the inflation rate for a given date. It uses the RegionalPhillipsCurve module to get 
-    the inflation rate for each region in the US and puts it on a heatmap using geopandas and matplotlib.
+    the inflation rate for each region in the data and puts it on a heatmap using geopandas and matplotlib.
+
+    Inputs:
+
+    date - a string in the format 'YYYY-MM-01'
 
-    Inputs: date - a string in the format 'YYYY-MM-01'
+    cmap - the name of the matplotlib colormap used for the heatmap
 
-    Outputs: A matplotlib plot of the unemployment rate for each region in the US.
+    Outputs: A matplotlib plot of the inflation rate for each region.
     """
 
-    #Getting the shape of the US Census Bureau regions for the US
-    shapefile_path = "cb_2018_us_region_500k/cb_2018_us_region_500k.shp"
+    return _draw_spatial_map("Inflation", date, cmap)
 
-    #Reading the file using geopandas read_file function
-    gdf = gpd.read_file(shapefile_path).sort_values(by = 'NAME')
 
-    inflation_rates = rpc.output_regional_inflation(date)
+#Resolution the frames of an animation are rendered at, lower than MAP_DPI since an animation has hundreds of frames
+ANIMATION_DPI = 80
 
-    gdf['Inflation Rate'] = inflation_rates
 
-    # Create a plot using matplotlib subplots function
-    fig, ax = plt.subplots(figsize=(10, 10))
+@instrumented()
+def animate_spatial_map(variable, start_date, end_date, output_path, cmap = 'coolwarm', fps = 12, dpi = ANIMATION_DPI, color_range = None):
+    """
+    This function renders the heatmap of unemployment or inflation for every month between two dates as an animation. Rather than building a
+    whole map per month like output_spatial_unemployment and output_spatial_inflation do, the geometry, the colorbar and the labels are drawn
+    once, and every frame only changes the colors of the regions, the text of the labels and the title. The color scale is fixed across the
+    frames, so the colors of two months can be compared.
 
-    # Plot the GeoDataFrame using geopandas plot function
-    gdf.plot(ax=ax, edgecolor='black', column='Inflation Rate', cmap='coolwarm', legend=True)
+    Inputs:
 
-    #Setting the coordinates where unemployment rates will be displayed manually (indexing into the unemployment_rates list)
-    ax.text(-93, 42, f"{inflation_rates[0]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting Midwest
-    ax.text(-74, 42.5, f"{inflation_rates[1]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting Northeast
-    ax.text(-90, 33, f"{inflation_rates[2]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting South
-    ax.text(-112, 40, f"{inflation_rates[3]}%", fontsize=10, ha='center', fontweight = 'bold') #Setting West
+    variable - a string that is either "Unemployment" or "Inflation"
 
-    ax.set_xlim(-125, -66)  # Longitude bounds
-    ax.set_ylim(25, 50) # Latitude bounds
+    start_date, end_date - the first and last months of the animation (Strings in yyyy-mm-01 format, both included)
 
-    # Set plot title and labels
-    ax.set_title('Inflation Rates by US Census Bureau Region for ' + date, fontweight = 'bold')
+    output_path - where the animation goes: a path ending in .gif or .mp4 (mp4 needs ffmpeg), or otherwise a folder that one PNG per month is
+    written to (named after the date)
+
+    cmap - the name of the matplotlib colormap used for the heatmap
+
+    fps - the frames (months) per second of a gif or mp4
+
+    dpi - the resolution of the frames
+
+    color_range - the (minimum, maximum) of the color scale, which defaults to the smallest and largest values in the date range
+
+    Outputs: A dictionary with the number of frames ("frames"), the paths that were written ("paths") and the seconds spent rendering ("seconds")
+    """
+
+    started = time.perf_counter()
+
+    if variable not in ("Unemployment", "Inflation"):
+        raise ValueError(f"Invalid variable {variable!r}. Please choose either 'Unemployment' or 'Inflation'.")
+
+    dates, values = rpc.lookup_regional_range(variable, start_date, end_date)
+    if len(dates) == 0:
+        raise ValueError(f"There is no {variable.lower()} data between {start_date} and {end_date}.")
+
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".mp4" and not animation.FFMpegWriter.isAvailable():
+        raise ValueError("Writing an mp4 needs ffmpeg, which could not be found. Write a gif or a folder of frames instead.")
+    if extension not in (".gif", ".mp4"):
+        os.makedirs(output_path, exist_ok = True)
+
+    #Matching the columns of the data to the geometry by name once, so every frame is one gather of the values
+    gdf = get_region_geometry()
+    keys = [region_key(region) for region in rpc.get_lookup_table(variable)["regions"]]
+    columns = np.array([keys.index(region_key(name)) if region_key(name) in keys else -1 for name in gdf[GEOMETRY_NAME_COLUMN]])
+    matched = columns >= 0
+    frames = np.asarray(values, dtype = np.float64)[:, columns[matched]]
+
+    if color_range is None:
+        color_range = (np.nanmin(frames), np.nanmax(frames))
+
+    fig = Figure(figsize=(10, 10), dpi = dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    #Regions without data are drawn in grey, and the regions with data with the fixed color scale
+    if not matched.all():
+        gdf[~matched].plot(ax=ax, edgecolor='black', color='lightgrey')
+    column = f"{variable} Rate"
+    regions = gdf[matched].copy()
+    regions[column] = frames[0]
+    regions.plot(ax=ax, edgecolor='black', column=column, cmap=cmap, legend=True, vmin=color_range[0], vmax=color_range[1])
+    collection = ax.collections[-1]
+
+    #geopandas draws every part of a multipolygon as its own patch, so every value is repeated once per part
+    parts = shapely.get_num_geometries(np.asarray(regions.geometry))
+
+    labels = []
+    if matched.sum() <= MAX_LABELED_REGIONS:
+        labels = [ax.text(x, y, "", fontsize=10, ha='center', fontweight = 'bold') for x, y in label_points(regions)]
+
+    ax.set_xlim(MAP_BOUNDS[0], MAP_BOUNDS[2])  # Longitude bounds
+    ax.set_ylim(MAP_BOUNDS[1], MAP_BOUNDS[3]) # Latitude bounds
+    title = ax.set_title("", fontweight = 'bold')
     ax.set_xlabel('Longitude', fontweight = 'bold')
     ax.set_ylabel('Latitude', fontweight = 'bold')
 
-    return fig
+    #Everything but the regions, the labels and the title is drawn once and kept as the background of every frame (blitting)
+    changing = [collection, *labels, title]
+    for artist in changing:
+        artist.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    def update(frame):
+        collection.set_array(np.repeat(frames[frame], parts))
+        for label, rate in zip(labels, frames[frame]):
+            label.set_text("" if np.isnan(rate) else f"{rate}%")
+        title.set_text(f'{variable} Rates by {REGION_LABEL} for ' + dates[frame])
+
+    def render(frame):
+        update(frame)
+        canvas.restore_region(background)
+        for artist in changing:
+            ax.draw_artist(artist)
+
+        #Copying the pixels out, since the canvas reuses its buffer for the next frame
+        return Image.fromarray(np.array(canvas.buffer_rgba())).convert('RGB')
+
+    paths = []
+    if extension == ".gif":
+        #Every frame is cut down to a palette right away, which keeps the frames held until the gif is written small
+        images = [render(frame).quantize(method = Image.Quantize.FASTOCTREE) for frame in range(len(dates))]
+        images[0].save(output_path, save_all = True, append_images = images[1:], duration = int(1000 / fps), loop = 0)
+        paths.append(output_path)
+    elif extension == ".mp4":
+        #ffmpeg takes the frames from matplotlib's writer, which draws the whole figure for every frame (only the data changes)
+        writer = animation.FFMpegWriter(fps = fps)
+        with writer.saving(fig, output_path, dpi):
+            for frame in range(len(dates)):
+                update(frame)
+                writer.grab_frame()
+        paths.append(output_path)
+    else:
+        for frame in range(len(dates)):
+            path = os.path.join(output_path, f"{dates[frame]}.png")
+            render(frame).save(path)
+            paths.append(path)
+
+    return {"frames": len(dates), "paths": paths, "seconds": time.perf_counter() - started}
+
+
+#Rendered maps as PNG bytes, maps (variable, date, style) to the bytes in least recently used order
+_map_cache = OrderedDict()
+_map_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+_map_cache_lock = threading.Lock()
+
+#Only one map is drawn at a time, matplotlib and geopandas aren't safe to draw with from several threads at once
+_render_lock = threading.Lock()
+
+
+def render_spatial_map(variable, date, style = 'coolwarm'):
+    """
+    This function returns the spatial heatmap of unemployment or inflation for a date as PNG bytes. Maps are only drawn the first time
+    they are requested and then served from an in-memory cache that evicts the least recently used maps once the total size of the
+    cache goes above MAP_CACHE_MAX_BYTES.
+
+    Inputs:
+
+    variable - a string that is either "Unemployment" or "Inflation"
 
+    date - a string in the format 'YYYY-MM-01'
+
+    style - the name of the matplotlib colormap used for the heatmap
+
+    Outputs: The bytes of the PNG image of the map
+    """
+
+    #The data version is part of the key, so a map is drawn again once the csv files change
+    key = (variable, date, style, rpc.get_data_version())
+
+    with _map_cache_lock:
+        if key in _map_cache:
+            _map_cache.move_to_end(key)
+            _map_cache_stats["hits"] += 1
+            return _map_cache[key]
+        _map_cache_stats["misses"] += 1
+
+    if variable == "Unemployment":
+        draw = output_spatial_unemployment
+    elif variable == "Inflation":
+        draw = output_spatial_inflation
+    else:
+        raise ValueError(f"Invalid variable {variable!r}. Please choose either 'Unemployment' or 'Inflation'.")
+
+    with _render_lock:
+        buffer = io.BytesIO()
+        figure = draw(date, cmap = style)
+        with span("DataVisualizations.encode_png"):
+            figure.savefig(buffer, format = 'png', dpi = MAP_DPI, bbox_inches = 'tight')
+        image = buffer.getvalue()
+
+    with _map_cache_lock:
+        if key not in _map_cache:
+            _map_cache[key] = image
+            _map_cache_stats["bytes"] += len(image)
+
+        #Evicting the least recently used maps until we are back under the size limit (always keeping the map we just drew)
+        while _map_cache_stats["bytes"] > MAP_CACHE_MAX_BYTES and len(_map_cache) > 1:
+            _, evicted = _map_cache.popitem(last = False)
+            _map_cache_stats["bytes"] -= len(evicted)
+            _map_cache_stats["evictions"] += 1
+
+    return image
+
+
+def get_map_cache_stats():
+    """
+    Returns the counters of the rendered map cache.
+
+    Outputs: A dictionary with the number of cache hits, misses and evictions, the number of maps held and their total size in bytes
+    """
+
+    with _map_cache_lock:
+        return dict(_map_cache_stats, entries = len(_map_cache))
+
+
+def prerender_maps(variables = ("Unemployment", "Inflation"), style = 'coolwarm'):
+    """
+    This function renders the map of every available date for the given variables into the rendered map cache, so that later requests for
+    those maps are only a lookup. Maps that are already cached are skipped. It takes a while, so it is meant to be run in a background thread
+    (see Streamlit.warm_up).
+
+    Inputs:
+
+    variables - the variables to render maps for ("Unemployment" and/or "Inflation")
+
+    style - the name of the matplotlib colormap used for the heatmap
+    """
 
-# output_spatial_unemployment('2020-01-01')
+    for variable in variables:
+        for date in rpc.get_lookup_table(variable)["dates"]:
+            render_spatial_map(variable, date, style)
 
 
 
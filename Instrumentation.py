@@ -0,0 +1,222 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# Every finished span is logged as one line of json to this logger (at the INFO level)
+logger = logging.getLogger("Instrumentation")
+
+# Whether spans are recorded, and whether their allocations are traced with tracemalloc too. Both are process-wide. Set the environment
+# variable RPC_INSTRUMENTATION to "1" (timing only) or "memory" to switch them on when the process starts, and RPC_INSTRUMENTATION_LOG to a
+# path to write the json logs to a file rather than stderr.
+_enabled = False
+_trace_memory = False
+_started_tracemalloc = False
+
+# Totals of every span name: the number of calls, the total and the longest wall time, the bytes still allocated when the spans finished
+# and the largest peak of allocations during one span
+_span_stats = {}
+_span_lock = threading.Lock()
+
+# The spans that are open on each thread, used to combine the allocation peaks of nested spans
+_open_spans = threading.local()
+
+
+def enable(memory = False, log_path = None):
+    """
+    This function switches the instrumentation on for the whole process. Calling it again changes the settings.
+
+    Inputs:
+
+    memory - Whether to trace the allocations of every span with tracemalloc (this slows the code down, so it is off by default). The
+    allocations are traced process-wide, so spans that run at the same time on several threads see each other's allocations.
+
+    log_path - A file to append the json logs of the spans to (one line per span). Without one the logs go to stderr, unless the logger
+    already has a handler.
+    """
+
+    global _enabled, _trace_memory, _started_tracemalloc
+
+    if log_path is not None and not any(getattr(handler, 'baseFilename', None) == os.path.abspath(log_path) for handler in logger.handlers):
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    elif log_path is None and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    #The level is set here rather than with the handlers, otherwise it falls back to WARNING and the span logs are never emitted
+    logger.setLevel(logging.INFO)
+
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    elif not memory and _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+    _trace_memory = memory
+    _enabled = True
+
+
+def disable():
+    """
+    Switches the instrumentation off (and stops tracemalloc if it was started for it). The totals recorded so far are kept.
+    """
+
+    global _enabled, _trace_memory, _started_tracemalloc
+
+    if _started_tracemalloc and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _started_tracemalloc = False
+
+    _enabled = False
+    _trace_memory = False
+
+
+def is_enabled():
+    """
+    Returns whether the instrumentation is switched on.
+    """
+
+    return _enabled
+
+
+class _Span:
+    """
+    A span that is being recorded. Use it through span() or instrumented() rather than directly.
+    """
+
+    __slots__ = ("name", "start", "start_memory", "max_memory")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _trace_memory:
+            stack = _open_spans.__dict__.setdefault("stack", [])
+            current, peak = tracemalloc.get_traced_memory()
+
+            # Handing the peak so far to the enclosing span before the peak is reset for this one
+            if stack:
+                stack[-1].max_memory = max(stack[-1].max_memory, peak)
+            tracemalloc.reset_peak()
+
+            self.start_memory = current
+            self.max_memory = current
+            stack.append(self)
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        allocated = peak = None
+
+        if _trace_memory and getattr(_open_spans, "stack", None):
+            stack = _open_spans.stack
+            current, traced_peak = tracemalloc.get_traced_memory()
+            self.max_memory = max(self.max_memory, traced_peak)
+            allocated = current - self.start_memory
+            peak = self.max_memory - self.start_memory
+
+            stack.pop()
+            if stack:
+                stack[-1].max_memory = max(stack[-1].max_memory, self.max_memory)
+            tracemalloc.reset_peak()
+
+        _record(self.name, seconds, allocated, peak)
+        return False
+
+
+def _record(name, seconds, allocated, peak):
+    """
+    Adds a finished span to the totals and logs it.
+    """
+
+    with _span_lock:
+        stats = _span_stats.get(name)
+        if stats is None:
+            stats = _span_stats[name] = {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0, "allocated_bytes": 0, "peak_bytes": 0}
+        stats["calls"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        if allocated is not None:
+            stats["allocated_bytes"] += allocated
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak)
+
+    if logger.isEnabledFor(logging.INFO):
+        record = {"event": "span", "name": name, "seconds": seconds, "allocated_bytes": allocated, "peak_bytes": peak,
+                  "thread": threading.current_thread().name, "time": time.time()}
+        logger.info(json.dumps(record))
+
+
+# Handed out by span() while the instrumentation is off, so a disabled span costs one check and nothing else
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def span(name):
+    """
+    Returns a context manager that records the wall time (and, if enabled, the allocations) of the code inside its with block under the
+    given name. While the instrumentation is off it does nothing.
+
+    Inputs: name - the name of the stage, such as "Regression.fit"
+    """
+
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def instrumented(name = None):
+    """
+    Decorator that records every call of a function as a span. While the instrumentation is off the only cost is one check per call.
+
+    Inputs: name - the name of the span (defaults to module.function)
+    """
+
+    def decorator(function):
+        span_name = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_span_stats():
+    """
+    Returns the totals of every span name recorded so far.
+
+    Outputs: A list of dictionaries sorted by total time (longest first) with the keys "name", "calls", "total_seconds", "mean_seconds",
+    "max_seconds", "allocated_bytes" and "peak_bytes" (the two byte counts are 0 unless allocations were traced)
+    """
+
+    with _span_lock:
+        rows = [dict(stats, name=name, mean_seconds=stats["total_seconds"] / stats["calls"]) for name, stats in _span_stats.items()]
+
+    columns = ["name", "calls", "total_seconds", "mean_seconds", "max_seconds", "allocated_bytes", "peak_bytes"]
+
+    return [{column: row[column] for column in columns} for row in sorted(rows, key=lambda row: row["total_seconds"], reverse=True)]
+
+
+def reset_span_stats():
+    """
+    Forgets the totals recorded so far.
+    """
+
+    with _span_lock:
+        _span_stats.clear()
+
+
+if os.environ.get("RPC_INSTRUMENTATION"):
+    enable(memory=os.environ["RPC_INSTRUMENTATION"] == "memory", log_path=os.environ.get("RPC_INSTRUMENTATION_LOG"))
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+# The requests sent by default: a mix of lookups, a series and regressions, some of which repeat
+DEFAULT_PATHS = [
+    "/unemployment?date=2020-04-01",
+    "/inflation?date=2022-06-01",
+    "/series?variable=Inflation&start=2000-01-01&end=2010-01-01",
+    "/regression?start=1990-01-01&end=2019-12-01",
+    "/regression?start=2000-01-01&end=2024-06-01&lag=2-lags&leverage=Omit+leverage+points+from+dataset",
+]
+
+
+async def _client(host, port, paths, count, latencies, errors):
+    """
+    Sends count requests one after the other over one keep-alive connection, cycling through the paths, and records the latency of every
+    request.
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        for index in range(count):
+            path = paths[index % len(paths)]
+            started = time.perf_counter()
+
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            json.loads(await reader.readexactly(length))
+
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append((path, status))
+    finally:
+        writer.close()
+
+
+async def run_load_test(host = "127.0.0.1", port = 8765, paths = None, requests = 2000, concurrency = 16):
+    """
+    This function measures the throughput and the latency of the API: concurrency clients each open one keep-alive connection and send
+    their share of the requests one after the other, as fast as the server answers them.
+
+    Inputs:
+
+    host, port - the address of the server
+
+    paths - the paths (with their queries) to request, cycled through by every client (defaults to DEFAULT_PATHS)
+
+    requests - the total number of requests
+
+    concurrency - the number of clients sending requests at the same time
+
+    Outputs: A dictionary with the number of requests, the errors (non-200 answers), the seconds the test took, the requests per second
+    and the 50th, 90th and 99th percentile and largest latencies in milliseconds
+    """
+
+    paths = paths or DEFAULT_PATHS
+    latencies = []
+    errors = []
+
+    shares = [requests // concurrency + (1 if index < requests % concurrency else 0) for index in range(concurrency)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, paths[index % len(paths):] + paths[:index % len(paths)], share, latencies, errors)
+                           for index, share in enumerate(shares) if share))
+    seconds = time.perf_counter() - started
+
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": float(p50),
+        "p90_ms": float(p90),
+        "p99_ms": float(p99),
+        "max_ms": float(max(latencies) * 1000),
+    }
+
+
+def main():
+    """
+    Command line entry point of the load test (start the server with ApiServer.py first).
+    """
+
+    parser = argparse.ArgumentParser(description="Measure the requests per second and the latency of the API server.")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server")
+    parser.add_argument("--port", type=int, default=8765, help="port of the server")
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of clients sending requests at the same time")
+    parser.add_argument("--paths", nargs="+", help="paths to request (defaults to a mix of lookups and regressions)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args.host, args.port, args.paths, args.requests, args.concurrency))
+
+    print(f"{report['requests']} requests in {report['seconds']:.2f}s ({report['errors']} errors)")
+    print(f"Requests/sec: {report['requests_per_second']:.1f}")
+    print(f"Latency (ms): p50 {report['p50_ms']:.2f}  p90 {report['p90_ms']:.2f}  p99 {report['p99_ms']:.2f}  max {report['max_ms']:.2f}")
+
+
+if __name__ == '__main__':
+    main()
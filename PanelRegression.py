@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+from scipy import linalg, stats
+import Regression as rg
+from Instrumentation import instrumented
+
+# The ways the standard errors can be clustered: by region (observations of the same region may be correlated over time) or by month
+# (observations of the same month may be correlated across regions)
+CLUSTER_OPTIONS = ["region", "time"]
+
+
+def _within(values, time_effects):
+    """
+    Removes the region fixed effects (and the time effects if requested) from a balanced panel of shape (months, regions, ...) by demeaning
+    rather than by adding a dummy variable per region and month: subtracting the mean of every region, and then the mean of every month.
+    """
+
+    values = values - values.mean(axis = 0)
+    if time_effects:
+        values = values - values.mean(axis = 1, keepdims = True)
+
+    return values
+
+
+def _inverse(normal):
+    """
+    Inverts a normal matrix through its Cholesky factorization, falling back to the pseudo-inverse when the matrix is singular (for example
+    when unemployment doesn't vary over the time period), which gives the same minimum norm solution as the rest of the regressions.
+    """
+
+    try:
+        factor = linalg.cho_factor(normal)
+    except linalg.LinAlgError:
+        return np.linalg.pinv(normal, hermitian = True)
+
+    return linalg.cho_solve(factor, np.eye(len(normal)))
+
+
+def _common_slope(x_data, y_data, time_effects):
+    """
+    Fits one set of lag coefficients shared by every region to the demeaned panel.
+
+    Outputs: A tuple of the inverse of the normal matrix (lags + 1 square), the coefficients, the residuals of shape (months, regions) and a function that
+    returns the scores summed within every cluster (by "region" or "time")
+    """
+
+    x_within = _within(x_data, time_effects)
+    y_within = _within(y_data, time_effects)
+
+    inverse = _inverse(np.einsum('trp,trq->pq', x_within, x_within))
+    coefficients = inverse @ np.einsum('trp,tr->p', x_within, y_within)
+    residuals = y_within - x_within @ coefficients
+
+    def cluster_scores(cluster):
+        # The score of every observation is its demeaned x row times its residual, summed over the months of a region or the regions of a month
+        return (x_within * residuals[:, :, None]).sum(axis = 0 if cluster == "region" else 1)
+
+    return inverse, coefficients, residuals, cluster_scores
+
+
+def _region_slopes(x_data, y_data, time_effects):
+    """
+    Fits lag coefficients for every region to the demeaned panel. Without time effects the normal matrix is block diagonal (one block per
+    region), so every block is inverted on its own in one batched call and the inverse of the normal matrix is those blocks on the diagonal.
+    With time effects, the demeaned design column of region i at region j and month t works out to ([j == i] - 1/R) u_it, where u is the
+    unemployment data demeaned within the region, so the normal matrix is the block diagonal minus U'U / R. It is built from those blocks
+    directly, never from a design with a column per region and lag, and inverted as a whole.
+
+    Outputs: A tuple of the inverse of the normal matrix (regions * (lags + 1) square), the coefficients (regions, lags + 1), the residuals of shape
+    (months, regions) and a function that returns the scores summed within every cluster (by "region" or "time")
+    """
+
+    months, regions, lags = x_data.shape
+    share = 1.0 / regions if time_effects else 0.0
+
+    demeaned = x_data - x_data.mean(axis = 0)
+    y_within = _within(y_data, time_effects)
+
+    blocks = np.einsum('tip,tiq->ipq', demeaned, demeaned)
+
+    # The demeaned y data sums to zero over the regions of every month when there are time effects, so the 1/R part drops out of X'y
+    right_hand_side = np.einsum('tip,ti->ip', demeaned, y_within)
+
+    if time_effects:
+        flat = demeaned.reshape(months, regions * lags)
+        normal = linalg.block_diag(*blocks) - share * (flat.T @ flat)
+        inverse = _inverse(normal)
+        coefficients = (inverse @ right_hand_side.ravel()).reshape(regions, lags)
+    else:
+        # Same minimum norm solution as _inverse when unemployment doesn't vary in a region over the time period
+        block_inverses = np.linalg.pinv(blocks, hermitian = True)
+        coefficients = np.einsum('ipq,iq->ip', block_inverses, right_hand_side)
+        inverse = linalg.block_diag(*block_inverses)
+
+    predictions = np.einsum('tip,ip->ti', demeaned, coefficients)
+    residuals = y_within - (predictions - share * predictions.sum(axis = 1, keepdims = True))
+
+    def cluster_scores(cluster):
+        if cluster == "time":
+            # Month t: the block of region i is u_it times (e_it minus the 1/R share of the residuals of the month)
+            adjusted = residuals - share * residuals.sum(axis = 1, keepdims = True)
+            return (demeaned * adjusted[:, :, None]).reshape(months, regions * lags)
+
+        # Region g: the block of region i is [g == i] u_i'e_g minus u_i'e_g / R
+        cross = np.einsum('tip,tg->gip', demeaned, residuals)
+        scores = -share * cross
+        scores[np.arange(regions), np.arange(regions)] += cross[np.arange(regions), np.arange(regions)]
+        return scores.reshape(regions, regions * lags)
+
+    return inverse, coefficients, residuals, cluster_scores
+
+
+@instrumented()
+def panel_regression(time_period, type_of_regression = "No lag", type_of_fit = "No Transformation", region_slopes = False, time_effects = False, cluster = "region"):
+    """
+    This function fits the Phillips curve of every region at once as a panel: all of the regions are stacked into one regression with a
+    fixed effect (intercept) per region, optionally a fixed effect per month (shocks that hit every region at once), and either one set of lag
+    coefficients shared by every region or a set per region. The fixed effects are removed by demeaning the data (the within transformation)
+    rather than estimated with a dummy variable per region and month, so the size of the system only depends on the number of coefficients.
+    The standard errors are clustered, and with region-specific slopes an F test says whether the slopes differ across regions.
+
+    Inputs:
+
+    time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    region_slopes - If True, every region gets its own lag coefficients, otherwise they are shared by every region
+
+    time_effects - If True, every month gets a fixed effect shared by every region
+
+    cluster - A string from CLUSTER_OPTIONS, what the standard errors are clustered by. With the four census regions there are only four
+    clusters by region, which makes those standard errors rough, so clustering by month is offered too.
+
+    Outputs:
+    A dictionary with the keys:
+
+    "coefficients" - A pandas dataframe with one row per coefficient and the columns "region" ("All" for shared coefficients), "lag" (0 for
+    u(t), 1 for u(t-1), ...), "estimate", "standard_error", "t_stat" and "p_value"
+
+    "long_run" - A pandas dataframe with the long-run slope (the sum of the lag coefficients) of every region (or "All") and the same columns
+
+    "region_effects" - A dictionary that maps a region to its fixed effect
+
+    "time_effects" - A dictionary that maps a date to its fixed effect (None without time effects). The time effects average to zero.
+
+    "slope_equality" - With region-specific slopes, a dictionary with the "f_stat", the degrees of freedom ("df_numerator", "df_denominator")
+    and the "p_value" of the F test that every region has the same slopes, otherwise None
+
+    "r2_within" - The R^2 of the demeaned data, "n" - the number of observations, "months" - the number of months, "clusters" - the number of clusters
+    """
+
+    if cluster not in CLUSTER_OPTIONS:
+        raise ValueError(f"Invalid cluster {cluster!r}. Please choose one of: {', '.join(CLUSTER_OPTIONS)}.")
+
+    dates, x_data, y_data, regions = rg.aligned_history(type_of_regression, type_of_fit)
+    rows = rg.period_rows(dates, time_period)
+    dates, x_data, y_data = dates[rows], x_data[rows], y_data[rows]
+
+    # The panel is kept balanced by dropping the months where any region has no usable value (the log of a negative inflation rate)
+    complete = np.isfinite(y_data).all(axis = 1) & np.isfinite(x_data).all(axis = (1, 2))
+    dates, x_data, y_data = dates[complete], np.asarray(x_data[complete], dtype = np.float64), np.asarray(y_data[complete], dtype = np.float64)
+
+    months, n_regions, lags = x_data.shape
+    if months < lags + 2:
+        raise ValueError("The time period doesn't have enough months of data for the panel regression.")
+
+    if region_slopes:
+        bread, coefficients, residuals, cluster_scores = _region_slopes(x_data, y_data, time_effects)
+    else:
+        bread, coefficients, residuals, cluster_scores = _common_slope(x_data, y_data, time_effects)
+
+    # Clustered covariance (the sandwich estimator) with the same small sample correction as Stata's xtreg, fe
+    scores = cluster_scores(cluster)
+    clusters = len(scores)
+    n = months * n_regions
+    n_coefficients = coefficients.size
+
+    correction = clusters / (clusters - 1) * (n - 1) / (n - n_coefficients) if clusters > 1 else 1.0
+    covariance = correction * bread @ (scores.T @ scores) @ bread
+
+    labels = regions if region_slopes else ["All"]
+    estimates = coefficients.ravel()
+    standard_errors = np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+    # Sums of the lag coefficients of every region, with their variance from the blocks of the covariance
+    long_run = coefficients.reshape(len(labels), lags).sum(axis = 1)
+    summing = np.kron(np.eye(len(labels)), np.ones(lags))
+    long_run_errors = np.sqrt(np.clip(np.diag(summing @ covariance @ summing.T), 0, None))
+
+    def table(names, lag_labels, values, errors):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t_stats = values / errors
+        # The t statistics of clustered standard errors are compared to a t distribution with one fewer degrees of freedom than clusters
+        p_values = 2 * stats.t.sf(np.abs(t_stats), max(clusters - 1, 1))
+        frame = pd.DataFrame({"region": names, "estimate": values, "standard_error": errors, "t_stat": t_stats, "p_value": p_values})
+        if lag_labels is not None:
+            frame.insert(1, "lag", lag_labels)
+        return frame
+
+    # Recovering the fixed effects from the residuals of the undemeaned data
+    if region_slopes:
+        remainder = y_data - np.einsum('trp,rp->tr', x_data, coefficients)
+    else:
+        remainder = y_data - x_data @ coefficients
+    region_effects = remainder.mean(axis = 0)
+    month_effects = (remainder - region_effects).mean(axis = 1) if time_effects else None
+
+    # The F test compares the residuals of the fit with region-specific slopes to those of the fit with shared slopes
+    slope_equality = None
+    if region_slopes:
+        restricted = _common_slope(x_data, y_data, time_effects)[2]
+        restricted_ssr = float((restricted ** 2).sum())
+        ssr = float((residuals ** 2).sum())
+        df_numerator = (n_regions - 1) * lags
+        df_denominator = n - n_regions * lags - n_regions - (months - 1 if time_effects else 0)
+        f_stat = ((restricted_ssr - ssr) / df_numerator) / (ssr / df_denominator) if df_denominator > 0 and ssr > 0 else float('nan')
+        slope_equality = {"f_stat": f_stat, "df_numerator": df_numerator, "df_denominator": df_denominator, "p_value": float(stats.f.sf(f_stat, df_numerator, df_denominator))}
+
+    total = float((_within(y_data, time_effects) ** 2).sum())
+
+    return {
+        "coefficients": table(np.repeat(labels, lags), np.tile(np.arange(lags), len(labels)), estimates, standard_errors),
+        "long_run": table(labels, None, long_run, long_run_errors),
+        "region_effects": dict(zip(regions, region_effects.tolist())),
+        "time_effects": dict(zip(dates, month_effects.tolist())) if time_effects else None,
+        "slope_equality": slope_equality,
+        "r2_within": 1 - float((residuals ** 2).sum()) / total if total > 0 else 1.0,
+        "n": n,
+        "months": months,
+        "clusters": clusters,
+    }
@@ -1,101 +1,669 @@
+import hashlib
+import io
+import itertools
+import os
+import threading
+import numpy as np
 import pandas as pd
+import BinaryCache
+from Instrumentation import instrumented
+
+#Paths to the csv files, relative to the root of the repository (the app is always launched from there)
+CPI_PATH = 'data/Core CPI by Region.csv'
+UNEM_PATH = 'data/Unemployment Rate by Region.csv'
+
+#Process-wide store of the parsed datasets. Maps a csv path to a dictionary with the parsed data frame, the (mtime, size) signature and
+#content hash of the file it was parsed from, and a version number that changes every time the file is reloaded
+_dataset_store = {}
+_dataset_stats = {"hits": 0, "misses": 0, "reloads": 0}
+_dataset_lock = threading.Lock()
+
+#Source of the version numbers. They are never reused, not even after the store is cleared or a path points to another file, so a cache
+#keyed on get_data_version() can never serve results computed from other data
+_versions = itertools.count()
+
+
+def _parse_dataset(raw_bytes):
+    """
+    Parses the raw bytes of one of the regional csv files into a data frame whose numeric columns are backed by a read-only array, so that
+    the copy held by the store can never be modified through one of the frames handed out by the getters.
+
+    Inputs: raw_bytes - the bytes of the csv file
+
+    Output: A data frame from the pandas library with the dates in the first column and the regional series in the other columns
+    """
+
+    parsed = pd.read_csv(io.BytesIO(raw_bytes))
+
+    values = parsed.iloc[:, 1:].to_numpy(dtype = np.float64)
+    values.flags.writeable = False
+
+    frame = pd.DataFrame(values, columns = parsed.columns[1:], copy = False)
+    frame.insert(0, parsed.columns[0], parsed.iloc[:, 0].to_numpy())
+
+    return frame
+
+
+def _frame_from_table(table):
+    """
+    Turns a table read by BinaryCache.load_table into a data frame laid out like the csv files. The numeric columns stay backed by the
+    read-only memory-mapped values, so nothing is copied.
+
+    Inputs: table - the dictionary returned by BinaryCache.load_table
+
+    Output: A data frame from the pandas library with the dates in the first column and the regional series in the other columns
+    """
+
+    frame = pd.DataFrame(table["values"], columns = table["columns"], copy = False)
+    frame.insert(0, 'Time Period', table["dates"])
+
+    return frame
+
+
+def dataset_cache_name(path):
+    """
+    Returns the name of the binary copy of one of the csv files (see BinaryCache).
+    """
+
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def inflation_cache_name(horizon):
+    """
+    Returns the name of the binary copy of the inflation table for a horizon (see BinaryCache).
+    """
+
+    return f"Inflation ({horizon})"
+
+
+@instrumented("RegionalPhillipsCurve.load_dataset")
+def _read_dataset(path, raw_bytes = None, content_hash = None):
+    """
+    Reads one of the csv files for the dataset store. A fresh binary copy (see BinaryCache) is used when there is one, so the text only has
+    to be parsed when the copy is missing or out of date.
+
+    Inputs:
+
+    path - the path to the csv file
+
+    raw_bytes - the bytes of the csv file, if they were already read
+
+    content_hash - the SHA-256 hash of those bytes
+
+    Output: A tuple of the data frame and the hash of the csv file it came from
+    """
+
+    table = BinaryCache.load_table(dataset_cache_name(path), path, content_hash)
+    if table is not None:
+        return _frame_from_table(table), table["hash"]
+
+    if raw_bytes is None:
+        with open(path, 'rb') as file:
+            raw_bytes = file.read()
+        content_hash = hashlib.sha256(raw_bytes).hexdigest()
+
+    return _parse_dataset(raw_bytes), content_hash
+
+
+def _dataset_entry(path):
+    """
+    Returns the store entry for a csv file, reading the file the first time it is requested and again when it changes on disk: a changed
+    mtime or size triggers a hash of the contents, and the file is only read again if that hash differs from the one it was last read from.
+
+    Inputs: path - the path to the csv file
+
+    Output: The dictionary kept in the store for this file (with the keys "frame", "signature", "hash" and "version")
+    """
+
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _dataset_lock:
+        entry = _dataset_store.get(path)
+
+        if entry is not None and entry["signature"] == signature:
+            _dataset_stats["hits"] += 1
+            return entry
+
+        if entry is None:
+            _dataset_stats["misses"] += 1
+            frame, content_hash = _read_dataset(path)
+            entry = {"frame": frame, "hash": content_hash, "version": next(_versions)}
+            _dataset_store[path] = entry
+
+        else:
+            with open(path, 'rb') as file:
+                raw_bytes = file.read()
+            content_hash = hashlib.sha256(raw_bytes).hexdigest()
+
+            if entry["hash"] == content_hash:
+                #The file was touched but its contents are the same, so the frame we have is still good
+                _dataset_stats["hits"] += 1
+
+            else:
+                _dataset_stats["reloads"] += 1
+                entry["frame"], entry["hash"] = _read_dataset(path, raw_bytes, content_hash)
+                entry["version"] = next(_versions)
+
+        entry["signature"] = signature
+
+        return entry
+
+
+def _load_dataset(path):
+    """
+    Returns the parsed data frame for a csv file from the process-wide dataset store.
+
+    Inputs: path - the path to the csv file
+
+    Output: A shallow copy of the stored data frame. Columns can be replaced on it freely, but its numbers are read-only views of the store.
+    """
+
+    return _dataset_entry(path)["frame"].copy(deep = False)
+
+
+def get_data_version():
+    """
+    Returns the versions of the CPI and unemployment datasets currently in the store (reloading them first if they changed on disk).
+    Anything derived from the data can be cached under this tuple and it will be invalidated when either file changes.
+
+    Output: A tuple of two integers, (CPI version, unemployment version)
+    """
+
+    return (_dataset_entry(CPI_PATH)["version"], _dataset_entry(UNEM_PATH)["version"])
+
+
+def get_dataset_stats():
+    """
+    Returns the hit, miss and reload counters of the dataset store. A hit is a getter call served from memory, a miss is the first parse
+    of a file and a reload is a re-parse because the file changed on disk.
+
+    Output: A dictionary with the keys "hits", "misses" and "reloads"
+    """
+
+    with _dataset_lock:
+        return dict(_dataset_stats)
+
+
+def clear_dataset_store():
+    """
+    Empties the dataset store and resets its counters, so the next getter call parses the csv files again.
+    """
+
+    with _dataset_lock:
+        _dataset_store.clear()
+        for key in _dataset_stats:
+            _dataset_stats[key] = 0
 
-# Need the absolute paths to the csv files because the current working directory is fucking with me for some reason
-#These are going to be global variables so I can access them at all times
 
 def get_cpi():
     """
-    Using a getter function for the CPI data which is good coding practice to not have global variables.
+    Using a getter function for the CPI data which is good coding practice to not have global variables. The csv is parsed once and then
+    served from the dataset store until the file changes.
     """
 
-    return pd.read_csv('data/Core CPI by Region.csv')
+    return _load_dataset(CPI_PATH)
 
 def get_unem():
     """
-    Using a getter function for the Unemployment data which is good coding practice to not have global variables.
+    Using a getter function for the Unemployment data which is good coding practice to not have global variables. The csv is parsed once
+    and then served from the dataset store until the file changes.
+
+    """
 
+    return _load_dataset(UNEM_PATH)
+
+
+#Mapping from the name of an inflation horizon to a tuple of (number of months to compare against, whether to annualize the change)
+INFLATION_HORIZONS = {
+    "Year over year": (12, False),
+    "Month over month": (1, False),
+    "3-month annualized": (3, True),
+    "6-month annualized": (6, True),
+}
+
+
+def _percent_change(levels, months, annualize):
+    """
+    Computes the inflation of every region from CPI levels, comparing every month with the month that is `months` rows earlier (the first
+    `months` rows have nothing to compare against), rounded to two digits.
+
+    Inputs:
+
+    levels - a numpy array of shape (months of CPI data, regions)
+
+    months, annualize - the horizon, as in INFLATION_HORIZONS
+
+    Output: A numpy array of shape (months of CPI data - months, regions) with the inflation of every row after the first `months`
     """
 
-    return pd.read_csv('data/Unemployment Rate by Region.csv')
-    
+    current = levels[months:]
+    previous = levels[:-months]
 
+    if annualize:
+        change = ((current / previous) ** (12 / months) - 1) * 100
+    else:
+        change = ((current - previous) / previous) * 100
 
+    return np.round(change, 2)
 
-def create_inflation():
+
+@instrumented()
+def create_inflation(horizon = "Year over year"):
     """
     This function will take my core cpi data and output an inflation data frame with date in one column and inflation by region
-    (measured as percent change in core CPI from the previous year) in the other 4 columns
+    (measured as percent change in core CPI over the chosen horizon, year over year by default) in the other columns. All of the
+    regions are computed at once from a single load of the CPI data, so there is no looping over the cells. If BinaryCache has a fresh
+    copy of the table it is read from there instead.
+
+    Inputs: horizon - A string that is one of the keys of INFLATION_HORIZONS ("Year over year", "Month over month", "3-month annualized"
+    or "6-month annualized") that specifies how far back each month is compared to
+
+    Output: A data frame from the pandas library with the dates in one column and the inflation by region (as float64) in the other columns
+    """
+
+    if horizon not in INFLATION_HORIZONS:
+        raise ValueError(f"Invalid inflation horizon {horizon!r}. Please choose one of: {', '.join(INFLATION_HORIZONS)}.")
 
-    Inputs: df_cpi - A data frame object from the pandas library
+    months, annualize = INFLATION_HORIZONS[horizon]
 
-    Output: A data frame from the pandas library with the dates in one column and the inflation by region in the other 4 columns
+    #Reading the table from its binary copy when there is one that was built from the current CPI data (and has a row for every month
+    #we have, since rows can be appended in memory without touching the csv file)
+    entry = _dataset_entry(CPI_PATH)
+    table = BinaryCache.load_table(inflation_cache_name(horizon), CPI_PATH, entry["hash"])
+    if table is not None and len(table["dates"]) == len(entry["frame"]) - months:
+        return _frame_from_table(table)
+
+    df_cpi = get_cpi()
+    levels = df_cpi.iloc[:, 1:].to_numpy(dtype = np.float64)
+
+    df_inflation = pd.DataFrame(_percent_change(levels, months, annualize), columns = df_cpi.columns[1:])
+
+    #Putting the dates in as the first column and resetting the index so that the first row has index 0
+    df_inflation.insert(0, "Time Period", df_cpi['Time Period'].iloc[months:].to_numpy())
+
+    return df_inflation
+
+
+#Cache of the date-indexed lookup tables. Maps (variable, inflation horizon) to a tuple of (data version, lookup table)
+_lookup_tables = {}
+
+
+def _month_ordinals(dates):
     """
+    Converts dates into integer month ordinals (year * 12 + month - 1), so that consecutive months are consecutive integers.
+
+    Inputs: dates - a list or array of dates (Strings in yyyy-mm-dd format, datetimes or numpy datetime64 values)
 
-    date_column = get_cpi()['Time Period'].iloc[12:450]
+    Output: A numpy array of integers with one month ordinal per date
+    """
 
-    df_inflation = pd.DataFrame({
-        "Time Period": date_column, 
-        "Midwest Region": None, 
-        "Northeast Region": None, 
-        "South Region": None, 
-        "West Region": None})
-    
+    months = pd.DatetimeIndex(pd.to_datetime(dates)).to_numpy().astype('datetime64[M]').astype(np.int64)
 
-    for row in range(12, 450):
+    #numpy counts months from 1970-01, so shifting by 1970 * 12 gives year * 12 + month - 1
+    return months + 1970 * 12
 
-        for col in range(1, 5):
 
-            #Doing a percent change from the year prior and rounding to two digits
-            df_inflation.iloc[row - 12, col] = round(((get_cpi().iloc[row, col] - get_cpi().iloc[row - 12, col]) / get_cpi().iloc[row - 12, col]) * 100, 2)
+@instrumented("RegionalPhillipsCurve.build_lookup_table")
+def _build_lookup_table(frame):
+    """
+    Builds a date-indexed lookup table from one of the regional data frames (dates in the first column, one column per region).
+
+    Inputs: frame - A data frame from the pandas library with the dates in the first column and the regional series in the other columns
+
+    Output: A dictionary with the date Strings ("dates"), the region names ("regions"), the (n_dates x n_regions) array of values ("values"),
+    the month ordinal of every row ("ordinals"), a mapping from date String to row ("positions") and whether the rows are consecutive months
+    ("contiguous")
+    """
 
-    #Resetting the index so that the first row has index 0 (this way we won't get incorrect numbers when we index into the data frame)
-    return df_inflation.reset_index(drop = True)
+    dates = frame['Time Period'].to_numpy()
+    values = frame.iloc[:, 1:].to_numpy(dtype = np.float64)
+    values.flags.writeable = False
+    ordinals = _month_ordinals(dates)
+
+    return {
+        "dates": dates,
+        "regions": list(frame.columns[1:]),
+        "values": values,
+        "ordinals": ordinals,
+        "positions": {date: row for row, date in enumerate(dates)},
+        "contiguous": bool(np.all(np.diff(ordinals) == 1)),
+    }
+
+
+def get_lookup_table(variable, horizon = "Year over year"):
+    """
+    Returns the date-indexed lookup table for unemployment or inflation. The table is built once and rebuilt only when the underlying csv
+    file changes, so the inflation table is no longer recomputed for every lookup.
+
+    Inputs:
+
+    variable - A string that is either "Unemployment" or "Inflation"
+
+    horizon - The inflation horizon (one of the keys of INFLATION_HORIZONS), only used for inflation
+
+    Output: The lookup table dictionary described in _build_lookup_table
+    """
+
+    if variable == "Unemployment":
+        key = (variable, None)
+        version = _dataset_entry(UNEM_PATH)["version"]
+    elif variable == "Inflation":
+        key = (variable, horizon)
+        version = _dataset_entry(CPI_PATH)["version"]
+    else:
+        raise ValueError(f"Invalid variable {variable!r}. Please choose either 'Unemployment' or 'Inflation'.")
+
+    cached = _lookup_tables.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    frame = get_unem() if variable == "Unemployment" else create_inflation(horizon)
+    table = _build_lookup_table(frame)
+    _lookup_tables[key] = (version, table)
+
+    return table
+
+
+def get_regions():
+    """
+    Returns the names of the regions, discovered from the header of the csv files (every column after the dates is a region), so the
+    analysis runs on however many regions the data has: census regions, states or metro areas. The CPI and unemployment files must have
+    the same regions.
+
+    Output: A list with the names of the regions in the order of the columns of the data
+    """
+
+    regions = list(get_lookup_table("Unemployment")["regions"])
+
+    if sorted(regions) != sorted(get_lookup_table("Inflation")["regions"]):
+        raise ValueError(f"The regions of {CPI_PATH} and {UNEM_PATH} don't match.")
+
+    return regions
+
+
+def find_date_rows(table, dates):
+    """
+    Finds the row of the lookup table for every date in a list. Consecutive monthly data is indexed by arithmetic on the month ordinal,
+    anything else by a binary search over the ordinals.
+
+    Inputs:
+
+    table - a lookup table from get_lookup_table
+
+    dates - a list or array of dates
+
+    Output: A numpy array of row numbers, with -1 for the dates that are not in the table
+    """
+
+    ordinals = _month_ordinals(dates)
+    table_ordinals = table["ordinals"]
+
+    if table["contiguous"]:
+        rows = ordinals - table_ordinals[0]
+    else:
+        rows = np.searchsorted(table_ordinals, ordinals)
+
+    in_bounds = (rows >= 0) & (rows < len(table_ordinals))
+    rows = np.where(in_bounds, rows, 0)
+    found = in_bounds & (table_ordinals[rows] == ordinals)
+
+    return np.where(found, rows, -1)
+
+
+def lookup_regional_values(variable, dates, horizon = "Year over year"):
+    """
+    Looks up the regional unemployment or inflation rates for many dates in one call.
+
+    Inputs:
+
+    variable - A string that is either "Unemployment" or "Inflation"
+
+    dates - a list or array of dates (Strings in yyyy-mm-01 format, datetimes or numpy datetime64 values)
+
+    horizon - The inflation horizon (one of the keys of INFLATION_HORIZONS), only used for inflation
+
+    Output: A numpy array of shape (number of dates, number of regions). The regions are in the order of the columns of the variable's csv
+    file (the "regions" of its lookup table), which for inflation can differ from get_regions.
+    """
+
+    table = get_lookup_table(variable, horizon)
+    rows = find_date_rows(table, dates)
+
+    if np.any(rows < 0):
+        missing = [str(date) for date, row in zip(dates, rows) if row < 0]
+        raise ValueError(f"No {variable.lower()} data for the dates: {', '.join(missing)}")
+
+    return table["values"][rows]
+
+
+def lookup_regional_range(variable, start_date, end_date, horizon = "Year over year"):
+    """
+    Looks up the regional unemployment or inflation rates for every month between two dates (both included).
+
+    Inputs:
+
+    variable - A string that is either "Unemployment" or "Inflation"
+
+    start_date - the first date of the range (String in yyyy-mm-01 format, datetime or numpy datetime64)
+
+    end_date - the last date of the range
+
+    horizon - The inflation horizon (one of the keys of INFLATION_HORIZONS), only used for inflation
+
+    Output: A tuple of two elements: 1) a numpy array with the date Strings in the range and 2) a numpy array of shape (number of dates,
+    number of regions) with the values for those dates
+    """
+
+    table = get_lookup_table(variable, horizon)
+    start_ordinal, end_ordinal = _month_ordinals([start_date, end_date])
+
+    first = np.searchsorted(table["ordinals"], start_ordinal, side = 'left')
+    last = np.searchsorted(table["ordinals"], end_ordinal, side = 'right')
+
+    return table["dates"][first:last], table["values"][first:last]
 
 
 def output_regional_unemployment(date):
     """
     This function takes in a valid date (between 1987-01-01 and 2024-06-01) and outputs the regional unemployment rates by region
-    for that year. They are output in alphabetical order, so Midwest, Northeast, South, West.
+    for that year. They are output in the order of the columns of the unemployment csv file (the same order as get_regions), which for
+    the census regions is alphabetical order, so Midwest, Northeast, South, West.
 
     Inputs: date - a string representing a year in yyyy-mm-01 format
 
-    Ouputs: A list with 4 elements representing the regional unemployment rates for the given date. They are output in alphabetical order.
+    Ouputs: A list with one element per region representing the regional unemployment rates for the given date.
     """
 
-    #Checking the bounds of the years
-    if date not in get_unem()['Time Period'].values:
-        return "Invalid date. Please enter a date between 1987-01-01 and the present in yyyy-mm-01 format."
+    table = get_lookup_table("Unemployment")
 
-    #Finding the index of the year in the data frame
-    index = get_unem()[get_unem()['Time Period'] == date].index[0]
+    #Checking the bounds of the years (this is a dictionary lookup, so we don't scan the dates)
+    if date not in table["positions"]:
+        return "Invalid date. Please enter a date between 1987-01-01 and the present in yyyy-mm-01 format."
 
-    #Returning a list using the index we previously found
-    return [get_unem().iloc[index, 1], get_unem().iloc[index, 2], get_unem().iloc[index, 3], get_unem().iloc[index, 4]]
+    #Returning a list using the row of the date
+    return list(table["values"][table["positions"][date]])
 
 
 def output_regional_inflation(date):
     """
     This function takes in a valid date (which is between 1988-01-01 and 2024-06-01) and outputs the regional unemployment rates 
-    by region for that year. They are output in alphabetical order, so Midwest, Northeast, South, West.
+    by region for that year. They are output in the order of the columns of the CPI csv file (get_lookup_table("Inflation")["regions"]),
+    which can differ from get_regions. For the census regions it is alphabetical order, so Midwest, Northeast, South, West.
 
     Inputs: date - a string representing a year in yyyy-mm-01 format
 
-    Ouputs: A list with 4 elements representing the regional inflation rates for the given date. They are output in alphabetical order.
+    Ouputs: A list with one element per region representing the regional inflation rates for the given date.
     """
-    #Getting my inflation data frame from the function
-    inflation = create_inflation()
+    #Getting my date-indexed inflation table (it is only rebuilt when the CPI data changes)
+    table = get_lookup_table("Inflation")
 
-    # #Checking if it is a valid date
-    if date not in inflation['Time Period'].values:
+    #Checking if it is a valid date
+    if date not in table["positions"]:
         return "Invalid date. Please enter a date between 1988-01-01 and the present in yyyy-mm-01 format."
 
-    #Finding the index of the year in the data frame   
-    index = inflation[inflation['Time Period'] == date].index[0]
+    #Returning a list using the row of the date
+    return list(table["values"][table["positions"][date]])
+
+
+def _append_dataset(path, rows, write):
+    """
+    Appends new monthly rows to one of the datasets in the store (and to its csv file if requested) without parsing anything again.
+
+    Inputs:
+
+    path - the path to the csv file
+
+    rows - a data frame from the pandas library with the same columns as the csv file
+
+    write - whether to also append the rows to the csv file
+
+    Output: The number of rows the dataset had before the new rows were added
+    """
+
+    entry = _dataset_entry(path)
+    frame = entry["frame"]
+    rows = pd.DataFrame(rows)
+
+    if list(rows.columns) != list(frame.columns):
+        raise ValueError(f"The new rows for {path} must have the columns: {', '.join(frame.columns)}.")
+
+    new_dates = pd.DatetimeIndex(pd.to_datetime(rows['Time Period'])).strftime('%Y-%m-%d').to_numpy().astype(object)
+    new_values = rows.iloc[:, 1:].to_numpy(dtype = np.float64)
+
+    if np.isnan(new_values).any():
+        raise ValueError(f"The new rows for {path} have missing values.")
+
+    #The new months have to pick up right after the last month we have and follow each other with no gaps
+    last_ordinal = _month_ordinals(frame['Time Period'].iloc[-1:])[0]
+    expected = np.arange(last_ordinal + 1, last_ordinal + 1 + len(new_dates))
+    if not np.array_equal(_month_ordinals(new_dates), expected) or any(not date.endswith('-01') for date in new_dates):
+        raise ValueError(f"The new rows for {path} must continue month by month (on the first of the month) from {frame['Time Period'].iloc[-1]}.")
+
+    with _dataset_lock:
+        if write:
+            with open(path, 'a') as file:
+                for date, values in zip(new_dates, new_values):
+                    file.write(f"{date},{','.join(repr(float(value)) for value in values)}\n")
+
+            stat = os.stat(path)
+            entry["signature"] = (stat.st_mtime_ns, stat.st_size)
+            entry["hash"] = BinaryCache.file_hash(path)
+
+        values = np.vstack([frame.iloc[:, 1:].to_numpy(dtype = np.float64), new_values])
+        values.flags.writeable = False
+
+        extended = pd.DataFrame(values, columns = frame.columns[1:], copy = False)
+        extended.insert(0, 'Time Period', np.concatenate([frame['Time Period'].to_numpy(), new_dates]))
+
+        entry["frame"] = extended
+        entry["version"] = next(_versions)
+
+    return len(frame)
+
+
+def _extend_lookup_table(table, frame, first):
+    """
+    Returns a copy of a lookup table with the rows of a data frame from row `first` onwards added to the end. The rows that were already in
+    the table are not looked at again.
+
+    Inputs:
+
+    table - a lookup table from get_lookup_table
+
+    frame - a data frame laid out like the csv files whose rows before `first` are the rows of the table
+
+    first - the first row of the frame that is not in the table yet
+
+    Output: The extended lookup table
+    """
+
+    new_dates = frame['Time Period'].to_numpy()[first:]
+    new_ordinals = _month_ordinals(new_dates)
+
+    values = np.vstack([table["values"], frame.iloc[first:, 1:].to_numpy(dtype = np.float64)])
+    values.flags.writeable = False
+
+    positions = dict(table["positions"])
+    positions.update({date: len(table["dates"]) + row for row, date in enumerate(new_dates)})
+
+    return {
+        "dates": np.concatenate([table["dates"], new_dates]),
+        "regions": table["regions"],
+        "values": values,
+        "ordinals": np.concatenate([table["ordinals"], new_ordinals]),
+        "positions": positions,
+        "contiguous": table["contiguous"],
+    }
+
+
+def _refresh_binary_copy(name, dates, columns, values, source_path, source_hash):
+    """
+    Rewrites the binary copy of a table (see BinaryCache) after rows were appended, but only if a copy was built in the first place.
+    """
+
+    if BinaryCache.has_table(name):
+        BinaryCache.save_table(name, dates, columns, values, source_path, source_hash)
+
+
+@instrumented()
+def append_observations(cpi_rows = None, unem_rows = None, write = True):
+    """
+    This function adds new months of CPI and/or unemployment data. The rows are checked to continue month by month from the last month we
+    have, appended to the csv files, and then only the new rows are worked through: the datasets in the store are extended instead of
+    parsed again, the inflation of the new months is computed from the last CPI levels, and the date-indexed lookup tables that were already
+    built are extended with the new rows. Anything cached under the data version (like the regression results) sees the new version, and
+    binary copies of the tables (see BinaryCache) are rewritten if they exist. The dashboard's date lists come from the lookup tables, so the
+    new months show up there right away.
+
+    Inputs:
+
+    cpi_rows - A data frame from the pandas library with the new CPI rows (same columns as the csv file), or None
+
+    unem_rows - A data frame from the pandas library with the new unemployment rows (same columns as the csv file), or None
+
+    write - whether to append the rows to the csv files. If False, only the data held in memory is extended.
+
+    Output: A dictionary with the number of CPI rows and unemployment rows that were added
+    """
+
+    added = {"cpi": 0, "unemployment": 0}
+
+    if unem_rows is not None and len(unem_rows) > 0:
+        table = get_lookup_table("Unemployment")
+        first = _append_dataset(UNEM_PATH, unem_rows, write)
+        entry = _dataset_entry(UNEM_PATH)
+        frame = entry["frame"]
+        added["unemployment"] = len(frame) - first
+
+        _lookup_tables[("Unemployment", None)] = (entry["version"], _extend_lookup_table(table, frame, first))
+
+        if write:
+            _refresh_binary_copy(dataset_cache_name(UNEM_PATH), frame['Time Period'].to_numpy(), frame.columns[1:], frame.iloc[:, 1:].to_numpy(), UNEM_PATH, entry["hash"])
 
-    #Returning a list using the index we previously found
-    return [inflation.iloc[index, 1], inflation.iloc[index, 2], inflation.iloc[index, 3], inflation.iloc[index, 4]]
+    if cpi_rows is not None and len(cpi_rows) > 0:
+        old_version = _dataset_entry(CPI_PATH)["version"]
+        first = _append_dataset(CPI_PATH, cpi_rows, write)
+        entry = _dataset_entry(CPI_PATH)
+        frame = entry["frame"]
+        levels = frame.iloc[:, 1:].to_numpy(dtype = np.float64)
+        added["cpi"] = len(frame) - first
 
+        for horizon, (months, annualize) in INFLATION_HORIZONS.items():
+            cached = _lookup_tables.get(("Inflation", horizon))
 
+            #Extending the inflation lookup tables that were built from the data we just added to. Only the new months are computed,
+            #each from the CPI level `months` rows before it.
+            if cached is not None and cached[0] == old_version:
+                new_inflation = pd.DataFrame(_percent_change(levels[first - months:], months, annualize), columns = frame.columns[1:])
+                new_inflation.insert(0, 'Time Period', frame['Time Period'].to_numpy()[first:])
+                _lookup_tables[("Inflation", horizon)] = (entry["version"], _extend_lookup_table(cached[1], new_inflation, 0))
 
+            if write and BinaryCache.has_table(inflation_cache_name(horizon)):
+                table = get_lookup_table("Inflation", horizon)
+                BinaryCache.save_table(inflation_cache_name(horizon), table["dates"], table["regions"], table["values"], CPI_PATH, entry["hash"])
 
+        if write:
+            _refresh_binary_copy(dataset_cache_name(CPI_PATH), frame['Time Period'].to_numpy(), frame.columns[1:], levels, CPI_PATH, entry["hash"])
 
+    return added
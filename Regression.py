@@ -1,11 +1,46 @@
+import re
+import threading
+import time
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import RegionalPhillipsCurve as rpc
-import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression as lm
+from BatchedOLS import batched_ols, flag_influential_points
+from Instrumentation import instrumented, span
 
+# Mapping from the type of regression the user picks to the number of lags of unemployment in the distributed-lag design (u_t, u_{t-1}, ..., u_{t-k})
+LAGS = {"No lag": 0, "1-lag": 1, "2-lags": 2, "3-lags": 3, "4-lags": 4}
 
-def main_function(time_period, type_of_regression, type_of_fit, leverage):
+# The other options the user can pick for a regression
+FIT_OPTIONS = ["No Transformation", "Log transform y array"]
+
+# Mapping from each way of removing points the user can pick to the criterion and the most rounds of removal passed to flag_influential_points
+# (None keeps removing points until no more are flagged)
+INFLUENCE_RULES = {
+    "Omit leverage points from dataset": ("leverage", 1),
+    "Omit leverage points from dataset (repeat until none are left)": ("leverage", None),
+    "Omit influential points from dataset (Cook's distance)": ("cooks", 1),
+    "Omit influential points from dataset (DFFITS)": ("dffits", 1),
+}
+LEVERAGE_OPTIONS = ["Leave leverage points in dataset"] + list(INFLUENCE_RULES)
+
+# Dates in the yyyy-mm-dd format the data uses, which period_rows can search for without parsing them
+_ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+# Limits of the regression result cache: the most results kept, the most bytes of data they may hold and how many seconds a result stays fresh
+RESULT_CACHE_MAX_ENTRIES = 256
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 60 * 60
+
+# Numeric regression results (cleaned data, fits and removed points, never figures) keyed by the normalized specification and the data version,
+# in least recently used order. This lives at module level, so every Streamlit session on the server shares it.
+_result_cache = OrderedDict()
+_result_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "bytes": 0}
+_result_cache_lock = threading.Lock()
+
+
+def main_function(time_period, type_of_regression, type_of_fit, leverage, numeric_only=False):
     """
     This function coordinates all of the other functions within this script and relies on them heavily to output the final result. This function is not long because it uses helper functions
     to do the majority of the nitty-gritty work. In the end, the basic structure of this function is calling the function that cleans the data to the specifications of the user, calling the 
@@ -20,48 +55,178 @@ def main_function(time_period, type_of_regression, type_of_fit, leverage):
 
     type_of_fit - A string that is either "linear" or "exponential" that specifies the type of fit that the user wants to perform
 
-    leverage - A string that is either "Leave leverage points in dataset" or "Omit leverage points from dataset" that specifies how the leverage points should be handled
+    leverage - A string from LEVERAGE_OPTIONS (such as "Leave leverage points in dataset" or "Omit leverage points from dataset") that specifies how the leverage points should be handled
+
+    numeric_only - If True, plain dictionaries of numbers are returned instead of RegressionResult objects, so nothing to do with figures (not even matplotlib) is ever touched
 
     Outputs:
     A list of two elements:
 
-    1) A dictionary that maps a region to a list of figures, R2 values, and coefficients.
+    1) A dictionary that maps a region to a RegressionResult, which can be indexed like a list of figure, R2 value, intercept and coefficients (the figure is drawn the first time
+    it is accessed). With numeric_only it maps a region to a dictionary with the keys "region", "r2", "intercept", "coefficients" (one per lag of unemployment), "slope" (their sum) and "n".
 
     2) A dictionary that maps a region to a list of dates that were removed from the dataset since they were leverage points.
     """
 
-    prepped_data, removed_leverage_points = clean_data(time_period, type_of_regression, type_of_fit, leverage)
-
+    results = fit_specification(time_period, type_of_regression, type_of_fit, leverage)
 
     output_mapping = {}
 
-    for region in prepped_data.keys():
-        x_data = prepped_data[region][0]
-        y_data = prepped_data[region][1]
+    # The numbers come from the result cache and the figures are only drawn if they are asked for
+    for region, (x_data, y_data, fit) in results["regions"].items():
+        result = RegressionResult(x_data, y_data, fit, time_period, type_of_regression, type_of_fit, region)
+        output_mapping[region] = result.to_record() if numeric_only else result
 
-        current_list = regression(x_data, y_data, time_period, type_of_regression, type_of_fit, region)
-        output_mapping[region] = current_list
+    # Handing out copies of the removed dates so the cached lists can't be changed by the caller
+    removed_leverage_points = {region: list(dates) for region, dates in results["removed"].items()} if results["removed"] else []
     
     return output_mapping, removed_leverage_points
 
 
 
+def normalize_specification(time_period, type_of_regression, type_of_fit, leverage):
+    """
+    This function puts a regression specification into a canonical form so that equivalent specifications share a cache entry (for example "2000-01-01" and a datetime for the same day).
+
+    Inputs: the same as main_function
+
+    Outputs: A tuple (start date, end date, type of regression, type of fit, leverage) with the dates as yyyy-mm-dd Strings
+    """
+
+    if type_of_regression not in LAGS:
+        raise ValueError(f"Invalid type of regression {type_of_regression!r}. Please choose one of: {', '.join(LAGS)}.")
+    if leverage not in LEVERAGE_OPTIONS:
+        raise ValueError(f"Invalid way of handling leverage points {leverage!r}. Please choose one of: {', '.join(LEVERAGE_OPTIONS)}.")
+
+    # Anything other than the log transform is fit without a transformation
+    if type_of_fit != "Log transform y array":
+        type_of_fit = "No Transformation"
+
+    start_date, end_date = (pd.to_datetime(date).strftime('%Y-%m-%d') for date in time_period)
+
+    # A reversed time period, or one with no data for this type of regression, would otherwise fail deep inside the fit with a numpy error
+    if start_date > end_date:
+        raise ValueError(f"Invalid time period {start_date} to {end_date}: the start date must not be after the end date.")
+    rows = period_rows(aligned_history(type_of_regression, type_of_fit)[0], [start_date, end_date])
+    if rows.stop <= rows.start:
+        raise ValueError(f"Invalid time period {start_date} to {end_date}: there is no data for a {type_of_regression} regression in it.")
+
+    return (start_date, end_date, type_of_regression, type_of_fit, leverage)
+
+
+@instrumented()
+def fit_specification(time_period, type_of_regression, type_of_fit, leverage):
+    """
+    This function returns the numeric results of a regression specification: the cleaned data and the fit of every region, and the points that were removed. Results are memoized in a
+    cache keyed on the normalized specification and the version of the data, so identical requests (from any Streamlit session) are only computed once and a change to the csv files
+    makes the old results unreachable. The cache evicts the least recently used results when it holds more than RESULT_CACHE_MAX_ENTRIES results or RESULT_CACHE_MAX_BYTES bytes of data,
+    and results older than RESULT_CACHE_TTL seconds are recomputed.
+
+    Inputs: the same as main_function
+
+    Outputs:
+    A dictionary with two keys:
+
+    "regions" - A mapping from region to a tuple of three elements: the cleaned x data (2-D numpy array), the cleaned y data (1-D numpy array) and the fit as a list of (R^2, intercept,
+    numpy array of coefficients). The arrays are read-only since they are shared with the cache.
+
+    "removed" - The mapping of removed dates returned by clean_data (an empty list when no points were removed)
+    """
+
+    specification = normalize_specification(time_period, type_of_regression, type_of_fit, leverage)
+    key = (specification, rpc.get_data_version())
+    now = time.monotonic()
+
+    with _result_cache_lock:
+        if key in _result_cache:
+            created, size, results = _result_cache[key]
+            if now - created <= RESULT_CACHE_TTL:
+                _result_cache.move_to_end(key)
+                _result_cache_stats["hits"] += 1
+                return results
+
+            # The result went stale, so it is dropped and recomputed below
+            del _result_cache[key]
+            _result_cache_stats["bytes"] -= size
+            _result_cache_stats["expirations"] += 1
+
+        _result_cache_stats["misses"] += 1
+
+    prepped_data, removed_leverage_points = clean_data(list(specification[:2]), type_of_regression, specification[3], leverage)
+
+    regions = list(prepped_data.keys())
+    x_list = [np.asarray(prepped_data[region][0], dtype=np.float64) for region in regions]
+    y_list = [np.asarray(prepped_data[region][1], dtype=np.float64) for region in regions]
+
+    # Fitting every region in one stacked solve rather than one model per region
+    with span("Regression.fit"):
+        fits = batched_ols(x_list, y_list)
+
+    results = {"regions": {}, "removed": removed_leverage_points}
+    size = 0
+    for index, region in enumerate(regions):
+        x_list[index].flags.writeable = False
+        y_list[index].flags.writeable = False
+        fit = [fits["r2"][index], fits["intercepts"][index], fits["coefficients"][index]]
+        results["regions"][region] = (x_list[index], y_list[index], fit)
+        size += x_list[index].nbytes + y_list[index].nbytes + fits["coefficients"][index].nbytes
+
+    # Rough size of the removed dates and of the dictionaries holding everything
+    size += 64 * sum(len(dates) for dates in removed_leverage_points.values()) if removed_leverage_points else 0
+    size += 1024
+
+    with _result_cache_lock:
+        if key not in _result_cache:
+            _result_cache[key] = (now, size, results)
+            _result_cache_stats["bytes"] += size
+
+        while len(_result_cache) > 1 and (len(_result_cache) > RESULT_CACHE_MAX_ENTRIES or _result_cache_stats["bytes"] > RESULT_CACHE_MAX_BYTES):
+            _, (_, evicted_size, _) = _result_cache.popitem(last=False)
+            _result_cache_stats["bytes"] -= evicted_size
+            _result_cache_stats["evictions"] += 1
+
+    return results
+
+
+def get_result_cache_stats():
+    """
+    Returns the counters of the regression result cache.
+
+    Outputs: A dictionary with the number of hits, misses, evictions and expirations, the number of results held and the estimated bytes they hold
+    """
+
+    with _result_cache_lock:
+        return dict(_result_cache_stats, entries=len(_result_cache))
+
+
+def clear_result_cache():
+    """
+    Empties the regression result cache and resets its counters.
+    """
+
+    with _result_cache_lock:
+        _result_cache.clear()
+        for key in _result_cache_stats:
+            _result_cache_stats[key] = 0
+
+
+@instrumented()
 def clean_data(time_period, type_of_regression, type_of_fit, leverage):
     """
     This function takes in the time period, type of regression, and type of fit and returns a mapping of the region to a list of 2 elements where the first element is a numpy array that represents
-    the x data that has been cleaned and the second element is a numpy array that represents the y data that has been cleaned (x data is 2 dimensional and y data is 1 dimensional). Note that since the 
-    x data is 2 dimensional, depending on the amount of lags requested by the user, there could be multiple different 1-D arrays within this numpy array object.
+    the x data that has been cleaned and the second element is a numpy array that represents the y data that has been cleaned (x data is 2 dimensional and y data is 1 dimensional). The x data
+    is the distributed-lag design of the region, so it has one column per lag of unemployment: u_t, u_{t-1}, ..., u_{t-k} where k is the number of lags requested by the user.
 
     Inputs:
 
     time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date (the Streamlit class will check the validity
     of these dates so we don't have to check that on the back-end here)
 
-    type_of_regression - A string that is either "1-lag" or "2-lag" that specifies the type of regression that the user wants to perform
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression that the user wants to perform
 
-    type_of_fit - A string that is either "linear" or "exponential" that specifies the type of fit that the user wants to perform
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit that the user wants to perform
 
-    leverage - A string that is either "Leave leverage points in dataset" or "Omit leverage points from dataset" that specifies how the leverage points should be handled
+    leverage - A string from LEVERAGE_OPTIONS (such as "Leave leverage points in dataset" or "Omit leverage points from dataset") that specifies how the leverage points should be handled
 
     Outputs:
 
@@ -69,37 +234,27 @@ def clean_data(time_period, type_of_regression, type_of_fit, leverage):
     and the second element is a numpy array that represents the y data that has been cleaned.
     """
 
-    unem_data, infl_data = create_data(time_period, type_of_regression)
+    dates, x_data, y_data, regions = aligned_history(type_of_regression, type_of_fit)
 
-    regional_data = matrix_to_mapping(unem_data, infl_data)
+    # Selecting the time period out of the lined up history (these are views, nothing is copied yet)
+    rows = period_rows(dates, time_period)
+    # An object array of timestamps, so the removed dates of every region are picked out without converting them one region at a time
+    dates = pd.to_datetime(dates[rows]).astype(object).to_numpy()
 
-    removed_indices = []
-    if leverage == "Omit leverage points from dataset":
-        regional_data, removed_indices = remove_leverage_points(regional_data)
-
-
-    # Initialize a dictionary to hold the cleaned data by region
-    data_by_region = {}
-
-    # Loop through each region
-    for region in regional_data.keys(): 
-        #We are grabbing the unemployment array from the mapping for the current region and turning it into a 2-D array so that it can be dealt with
-        x_data = regional_data[region][0][region].values.reshape(-1,1) #First indexing into the dictionary to get the list, then indexing into the list to get the first element, then indexing into the pandas dataframe to get the array
-
-        # Align y_data (inflation) with the lagged x_data (y_data is ok as a 1-D array)
-        y_data = regional_data[region][1][region].reset_index(drop=True) #First indexing into the dictionary to get the list, then indexing into the list to get the first element, then indexing into the pandas dataframe to get the array, then slicing the array
+    regional_data = {region: [x_data[rows, index, :], y_data[rows, index], dates] for index, region in enumerate(regions)}
 
-        # Log-transform the y_data if an exponential fit is requested
-        if type_of_fit == "Log transform y array":
-            y_data = np.log(y_data.astype(np.float64))
+    removed_indices = []
+    if leverage in INFLUENCE_RULES:
+        criterion, max_iterations = INFLUENCE_RULES[leverage]
+        regional_data, removed_indices = remove_leverage_points(regional_data, criterion, max_iterations)
 
-        # Store the cleaned x_data and y_data in the dictionary
-        data_by_region[region] = [x_data, y_data]
+    # Only keeping the x data and y data of every region
+    data_by_region = {region: [x_region, y_region] for region, (x_region, y_region, _) in regional_data.items()}
 
     return data_by_region, removed_indices
 
 
-def regression(x_data, y_data, time_period, type_of_regression, type_of_fit, region):
+def regression(x_data, y_data, time_period, type_of_regression, type_of_fit, region, fit = None):
     """
     This function takes in the x data and y data and performs linear regression on the data. It returns a list of 3 elements where the first element is a matplotlib object that represents the figure,
     the second element is a float that represents the R^2 value of the model, and the third element is a list that represents the coefficients of the model.
@@ -110,29 +265,64 @@ def regression(x_data, y_data, time_period, type_of_regression, type_of_fit, reg
 
     y_data - A numpy array that represents the y data that has been cleaned (1 dimensional)
 
+    fit - An optional list of three elements (R^2, intercept, numpy array of coefficients) when the regression has already been fit, for example by the batched solve in
+    main_function. If it is left out the regression is fit here.
+
     Outputs:
 
     A list of 3 elements where the first element is a matplotlib object that represents the figure, the second element is a float that represents the R^2 value of the model, and 
     the third element is a list that represents the coefficients of the model.
     """
-    # Initialize the Linear Regression model and fit it to the data
-    model = lm().fit(x_data, y_data)
+    # Fit the regression if it wasn't fit already
+    if fit is None:
+        fits = batched_ols([x_data], [y_data])
+        fit = [fits["r2"][0], fits["intercepts"][0], fits["coefficients"][0]]
+
+    # Retrieve the R^2 value and the coefficients
+    r_sq, intercept, coefficients = fit
+
+    fig = regression_figure(x_data, y_data, fit, time_period, type_of_regression, type_of_fit, region)
+
+    # Return the figure, R^2 value, and coefficients
+    return [fig, float(r_sq), float(intercept), coefficients.tolist()]
+
+
+@instrumented()
+def regression_figure(x_data, y_data, fit, time_period, type_of_regression, type_of_fit, region):
+    """
+    This function draws the scatter plot of the data and the regression line for one region. It is kept apart from the fit so that callers that only want numbers never have to draw
+    anything. The figure is created directly on the Agg backend rather than through pyplot, so pyplot never holds on to it and it is freed as soon as the caller lets go of it.
+
+    Inputs:
+
+    x_data - A numpy array that represents the x data that has been cleaned (2 dimensional)
+
+    y_data - A numpy array that represents the y data that has been cleaned (1 dimensional)
+
+    fit - A list of three elements (R^2, intercept, numpy array of coefficients)
+
+    time_period, type_of_regression, type_of_fit, region - used for the title
+
+    Outputs: A matplotlib figure
+    """
 
-    # Calculate the R^2 value
-    r_sq = model.score(x_data, y_data)
+    # Matplotlib is only imported once a figure is actually needed
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    # Retrieve the coefficients
-    intercept = model.intercept_
-    coefficients = model.coef_
+    _, intercept, coefficients = fit
 
-    # Generate points for plotting the regression line
-    x_line = np.linspace(x_data.min(), x_data.max(), 100).reshape(-1, x_data.shape[1])
-    y_line = model.predict(x_line)
+    # Generate points for plotting the regression line. With several lags the line is the long-run relationship, where unemployment stays at the same
+    # level for every lag, so its slope is the sum of the lag coefficients.
+    x_line = np.linspace(x_data[:, 0].min(), x_data[:, 0].max(), 100)
+    y_line = intercept + x_line * np.sum(coefficients)
 
     # Plot the scatter plot and regression line
-    fig, ax = plt.subplots()
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
     ax.scatter(x_data[:, 0], y_data, label='Data Points')
-    ax.plot(x_line[:, 0], y_line, color='red', label='Regression Line')
+    ax.plot(x_line, y_line, color='red', label='Regression Line' if x_data.shape[1] == 1 else 'Long-run Regression Line')
 
     # Title and labels (Assuming region information is available)
     if type_of_fit == "Log transform y array":
@@ -145,162 +335,269 @@ def regression(x_data, y_data, time_period, type_of_regression, type_of_fit, reg
     ax.set_ylabel('Inflation (yearly % change Core CPI)', fontweight='bold')
     ax.legend()
 
-    # Return the figure, R^2 value, and coefficients
-    return [fig, r_sq, intercept.tolist(), coefficients.tolist()]
+    return fig
 
-#HELPER FUNCTION FOR CLEAN_DATA
-def create_data(time_period, type_of_regression):
+
+class RegressionResult:
     """
-    This function takes in a time period and a type of regression and is going to output the unemployment matrices and inflation matrices for those time periods. Remember that this function is called
-    before matrix_to_mapping is called so we are dealing with matrices here.
+    The result of the regression for one region as returned by main_function. The numbers are available right away and the figure is only drawn the first time it is asked for.
+    For backwards compatibility it can still be indexed like the old list of [figure, R^2, intercept, coefficients].
+    """
+
+    def __init__(self, x_data, y_data, fit, time_period, type_of_regression, type_of_fit, region):
+        self.x_data = x_data
+        self.y_data = y_data
+        self.r2 = float(fit[0])
+        self.intercept = float(fit[1])
+        self.coefficients = np.asarray(fit[2]).tolist()
+        # The long-run slope: the total effect on inflation of unemployment staying one point higher, which is the only coefficient when there are no lags
+        self.slope = float(np.sum(fit[2]))
+        self._fit = fit
+        self._labels = (time_period, type_of_regression, type_of_fit, region)
+        self._figure = None
+
+    @property
+    def figure(self):
+        """
+        The matplotlib figure of the regression, drawn on first access.
+        """
+
+        if self._figure is None:
+            self._figure = regression_figure(self.x_data, self.y_data, self._fit, *self._labels)
+        return self._figure
+
+    def close(self):
+        """
+        Lets go of the figure (if it was drawn) so its memory can be freed. It is drawn again if it is asked for later.
+        """
+
+        if self._figure is not None:
+            self._figure.clear()
+            self._figure = None
+
+    def to_record(self):
+        """
+        Returns the numbers of the result as a plain dictionary.
+        """
+
+        return {"region": self._labels[3], "r2": self.r2, "intercept": self.intercept, "coefficients": list(self.coefficients), "slope": self.slope, "n": len(self.y_data)}
+
+    def __getitem__(self, index):
+        # Only draw the figure when it is the figure that is asked for
+        values = (None, self.r2, self.intercept, self.coefficients)
+        return self.figure if index in (0, -4) else values[index]
+
+    def __len__(self):
+        return 4
+
+    def __iter__(self):
+        return iter((self.figure, self.r2, self.intercept, self.coefficients))
+
+
+def distributed_lag_design(lags):
+    """
+    This function builds the distributed-lag design of every region at once. Row t of the design of a region holds the unemployment rates u_t, u_{t-1}, ..., u_{t-lags}, so a regression on it
+    estimates one coefficient per lag. The design is a strided sliding-window view of the unemployment data: every row points into the same memory as the data itself, so no matter how many lags
+    are asked for or how long the history is, nothing is copied.
 
     Inputs:
-    time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date (the Streamlit class will check the validity
-    of these dates so we don't have to check that on the back-end here)
 
-    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression that the user wants to perform
+    lags - The number of lags of unemployment (0 gives a design with only the current month)
 
     Outputs:
-    A tuple of two elements:
+    A tuple of four elements:
+
+    1) A numpy array with the dates (as Strings) of the rows of the design, the month t of every row
 
-    1) A pandas dataframe with 5 columns where the cells represent unemployment data: 1) time period, 2) Midwest Region, 3) Northeast Region, 4) South Region, 5) West Region
+    2) A read-only numpy array of shape (dates, regions, lags + 1) with the design, where column j holds u_{t-j}
 
-    2) A pandas dataframe with 5 columns where the cells represent inflation data: 1) time period, 2) Midwest Region, 3) Northeast Region, 4) South Region, 5) West Region
+    3) A boolean numpy array that is True for the rows whose lags are all consecutive months (always True unless months are missing from the data)
+
+    4) A list with the names of the regions
     """
-    # Fetching the datasets
-    unem_data = rpc.get_unem()
-    infl_data = rpc.create_inflation()
-
-    # Convert the 'Dates' columns to datetime objects
-    unem_data['Time Period'] = pd.to_datetime(unem_data['Time Period'])
-    infl_data['Time Period'] = pd.to_datetime(infl_data['Time Period'])
-
-    # Parse time period
-    start_date = pd.to_datetime(time_period[0])
-    end_date = pd.to_datetime(time_period[1])
-
-    # Determine the number of lags based on type_of_regression
-    if type_of_regression == "No lag":
-        lag = 0
-    elif type_of_regression == "1-lag":
-        lag = 1
-    elif type_of_regression == "2-lags":
-        lag = 2
-    elif type_of_regression == "3-lags":
-        lag = 3
-    elif type_of_regression == "4-lags":
-        lag = 4
-
-    # Adjust the start date to account for lags
-    adjusted_start_date = start_date - pd.DateOffset(months=lag)
-    adjusted_end_date = end_date - pd.DateOffset(months=lag)
-
-    # Filter the data based on the adjusted start date and end date
-    unem_data = unem_data[(unem_data['Time Period'] >= adjusted_start_date) & (unem_data['Time Period'] <= adjusted_end_date)].reset_index(drop=True)
-    infl_data = infl_data[(infl_data['Time Period'] >= start_date) & (infl_data['Time Period'] <= end_date)].reset_index(drop=True)
-
-    return unem_data, infl_data
 
-#HELPER FUNCTION FOR CLEAN_DATA
-def remove_leverage_points(regional_data):
+    unemployment = rpc.get_lookup_table("Unemployment")
+    values = unemployment["values"]
+    ordinals = unemployment["ordinals"]
+
+    # Window i covers the rows i to i + lags, and reversing it puts the newest month first so it lines up with the date of row i + lags
+    design = sliding_window_view(values, lags + 1, axis=0)[:, :, ::-1]
+
+    complete = ordinals[lags:] - ordinals[:len(ordinals) - lags] == lags
+
+    return unemployment["dates"][lags:], design, complete, unemployment["regions"]
+
+@instrumented()
+def aligned_history(type_of_regression, type_of_fit):
     """
-    Removes leverage points from the datasets based on the unemployment data (independent variable).
-    
+    This function lines up the whole history of the data for a type of regression and a type of fit, without any filtering by date. It is used by clean_data and by the estimators that
+    slide over the full history (such as the rolling window regression) rather than fitting one time period.
+
     Inputs:
-    regional_data - A mapping where the keys are the US Census Bureau regions in a String and the values are a list of two elements where the first element is a pandas dataframe with 2 columns
-    where the first column is the time period and the second column is the unemployment data and the second element is a pandas dataframe with 2 columns where the first column is the time period
-    and the second column is the inflation data.
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression that the user wants to perform
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit that the user wants to perform
 
     Outputs:
-    A list with two elements:
+    A tuple of four elements:
 
-    1) A mapping where the keys are the US Census Bureau regions in a String and the values are a list of two elements where the first element is a pandas dataframe with 2 columns
-    where the first column is the time period and the second column is the unemployment data and the second element is a pandas dataframe with 2 columns where the first column is the time period
-    and the second column is the inflation data. However, the leverage points for each US Census Bureau region have been removed.
+    1) A numpy array with the dates (as Strings) of the inflation data that have unemployment data for every lag
 
-    2) A mapping where the keys are the US Census Bureau regions in a String and the values are a list of the dates removed from the dataset since they were leverage points
+    2) A numpy array of shape (dates, regions, lags + 1) with the distributed-lag design of unemployment (the x data), see distributed_lag_design
+
+    3) A numpy array of shape (dates, regions) with the inflation data (the y data), log transformed if requested
+
+    4) A list with the names of the regions
     """
 
-    output_data_mapping = {}
-    output_indices_mapping = {}
+    lags = LAGS[type_of_regression]
+    _, design, complete, regions = distributed_lag_design(lags)
+
+    inflation = rpc.get_lookup_table("Inflation")
 
-    # Assume the first column is the 'Time Period', so we start from the second column
-    for region in regional_data.keys():  
+    # The design starts `lags` rows into the unemployment data, so the row of the design for every inflation date is its unemployment row minus the lags.
+    # We keep the dates where that row exists and has all of its lags.
+    rows = rpc.find_date_rows(rpc.get_lookup_table("Unemployment"), inflation["dates"]) - lags
+    keep = rows >= 0
+    keep[keep] = complete[rows[keep]]
+    rows = rows[keep]
+
+    # When the rows form one run (the usual case), slicing keeps the design a view of the unemployment data instead of gathering a copy
+    if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+        x_data = design[rows[0]:rows[-1] + 1]
+    else:
+        x_data = design[rows]
 
-        # Calculate leverage points using standardized residuals for unemployment data
-        current_unem_data = regional_data[region][0][region]
-        current_infl_data = regional_data[region][1][region]
+    y_data = inflation["values"][keep]
 
-        threshold = 4 / len(current_unem_data)  # Set the threshold for leverage points at 4 / n
+    # Matching the inflation columns to the regions of the design by name, in case the two csv files list the regions in a different order
+    if list(inflation["regions"]) != rpc.get_regions():
+        y_data = y_data[:, [list(inflation["regions"]).index(region) for region in regions]]
 
-        mean = np.mean(current_unem_data)
+    if type_of_fit == "Log transform y array":
+        y_data = np.log(y_data)
 
-        Sxx = 0
-        # Using this for loop to calculate Sxx
-        for stat in current_unem_data:
-            Sxx += ((stat - mean) ** 2)
-        
-        # Calculate standardized residuals
-        hii = (1 / len(current_unem_data)) + (((current_unem_data - mean) ** 2) / Sxx)
+    return inflation["dates"][keep], x_data, y_data, regions
 
-        # Identify indices of leverage points
-        leverage_indices = hii > threshold
+def _date_string(date):
+    """
+    Returns a date as a String in yyyy-mm-dd format. Dates that are already in that format (the usual case) are passed through without being parsed.
+    """
 
-        #Storing the unemployment data as a dataframe where the first column is the time period and the second column is the unemployment data
-        current_unem_dataframe = pd.DataFrame({'Time Period': regional_data[region][0]['Time Period'][~leverage_indices], region: current_unem_data[~leverage_indices]}).reset_index(drop=True)
-        current_infl_dataframe = pd.DataFrame({'Time Period': regional_data[region][1]['Time Period'][~leverage_indices], region: current_infl_data[~leverage_indices]}).reset_index(drop=True)
-                    
-        #Putting the unemployment dataframe and the inflation dataframe in our list
-        current_data_value = [current_unem_dataframe, current_infl_dataframe]
-        current_indices_value = regional_data[region][0]['Time Period'][leverage_indices].tolist() #Taking the leverage_indices variable from earlier and using it to select the YYYY-MM_DD that have been removed
+    if isinstance(date, str) and _ISO_DATE.fullmatch(date):
+        return date
 
-        # current_indices_value - [dt.strftime('%Y-%m-%d') for dt in current_indices_value] #Converting the datetime objects to strings so they print out nice
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
 
-        #Store the cleaned data and the indices
-        output_data_mapping[region] = current_data_value 
-        output_indices_mapping[region] = current_indices_value 
-    
+def period_rows(dates, time_period):
+    """
+    Returns the slice of the rows of the lined up history that fall in a time period. The dates are yyyy-mm-dd Strings in order, so the time period is found with a binary search.
+    """
 
-    return output_data_mapping, output_indices_mapping
+    first = np.searchsorted(dates, _date_string(time_period[0]), side='left')
+    last = np.searchsorted(dates, _date_string(time_period[1]), side='right')
 
+    return slice(first, last)
 
-#HELPER FUNCTION FOR CLEAN_DATA
-def matrix_to_mapping(unem_data, infl_data):
+@instrumented()
+def fit_aligned(history, time_period, leverage):
     """
-    This function is going to take our two matrices (which is a matrix for the unemployment data and a matrix for the inflation data) and output a mapping where the keys are the regions
-    in a String and the values are a list of two elements where the first element is the unemployment data and the second element is the inflation data. This matrix_to_mapping allows us
-    to tailor our removal of leverage points to each region rather than requiring the same amount of leverage points be removed from each region. If we were to keep our data in matrix form and 
-    get rid of a different number of leverage points for each region then we would no longer have a matrix and the code would throw an error.
+    This function is the numeric path of main_function for data that has already been lined up by aligned_history. It selects the time period, removes the leverage points if requested
+    and fits every region, without building any figures. Since the lined up data only depends on the type of regression and the type of fit, callers that fit many time periods
+    (such as the specification sweep) can prepare it once and reuse it for all of them.
 
     Inputs:
 
-    unem_data - A pandas dataframe with 5 columns where the cells represent unemployment data: 1) time period, 2) Midwest Region, 3) Northeast Region, 4) South Region, 5) West Region
-    infl_data - A pandas dataframe with 5 columns where the cells represent inflation data: 1) time period, 2) Midwest Region, 3) Northeast Region, 4) South Region, 5) West Region
+    history - The tuple returned by aligned_history
+
+    time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date
 
-    Output:
+    leverage - A string from LEVERAGE_OPTIONS (such as "Leave leverage points in dataset" or "Omit leverage points from dataset") that specifies how the leverage points should be handled
 
-    A mapping where the keys are a String of the US Census Bureau region and the values are a list of two elements where the first element is the unemployment data and the second element is the 
-    inflation data.
+    Outputs:
+    A dictionary that maps a region to a dictionary with the R^2 value ("r2"), the intercept ("intercept"), the list of coefficients ("coefficients", one per lag), the number of observations
+    that were fit ("n") and the number of leverage points that were removed ("removed").
     """
 
-    output_mapping = {}
+    dates, x_data, y_data, regions = history
 
-    date_array = unem_data["Time Period"] # Storing the time period array in the date_array variable outside the for loop so that we can insert this within every pandas dataframe as the first column
+    rows = period_rows(dates, time_period)
+    x_data = x_data[rows]
+    y_data = y_data[rows]
+    n = len(x_data)
 
-    for region in unem_data.columns[1:]:
+    x_list = [x_data[:, index, :] for index in range(len(regions))]
+    y_list = [y_data[:, index] for index in range(len(regions))]
 
-        current_pandas_unem = pd.DataFrame({'Time Period': date_array, region: unem_data[region]})
-        current_pandas_infl = pd.DataFrame({'Time Period': date_array, region: infl_data[region]})
+    if leverage in INFLUENCE_RULES:
+        # Same rules as remove_leverage_points, for all of the regions at once
+        criterion, max_iterations = INFLUENCE_RULES[leverage]
+        keep = flag_influential_points(x_list, y_list, criterion, max_iterations=max_iterations)
+        x_list = [x[mask] for x, mask in zip(x_list, keep)]
+        y_list = [y[mask] for y, mask in zip(y_list, keep)]
 
-        output_mapping[region] = [current_pandas_unem, current_pandas_infl]
+    fits = batched_ols(x_list, y_list)
 
+    output_mapping = {}
+    for index, region in enumerate(regions):
+        output_mapping[region] = {
+            "r2": float(fits["r2"][index]),
+            "intercept": float(fits["intercepts"][index]),
+            "coefficients": fits["coefficients"][index].tolist(),
+            "n": int(fits["n"][index]),
+            "removed": int(n - fits["n"][index]),
+        }
 
     return output_mapping
 
+#HELPER FUNCTION FOR CLEAN_DATA
+@instrumented()
+def remove_leverage_points(regional_data, criterion="leverage", max_iterations=1, threshold=None):
+    """
+    Removes leverage points from the datasets. By default these are the points with a hat value above 2 * p / n (twice the average hat value, where p counts the intercept and
+    every lag, so 4 / n without lags), which only depends on the unemployment data (independent variable),
+    but Cook's distance or DFFITS can be used instead (these also look at the inflation data). The measures for all of the regions are computed at once by flag_influential_points,
+    from the full distributed-lag design of every region.
+    
+    Inputs:
+    regional_data - A mapping where the keys are the US Census Bureau regions in a String and the values are a list of three elements: the x data (a 2-D numpy array with one column
+    per lag of unemployment), the y data (a 1-D numpy array of inflation, already log transformed if requested) and the dates of the rows
+
+    criterion - A string that is either "leverage", "cooks" or "dffits" that specifies which measure is used to find the points to remove
+
+    max_iterations - The most rounds of removal, or None to keep removing until no more points are flagged. After each round the measures are recomputed on the points that are left.
+
+    threshold - The cutoff above which points are removed (a number or a function of n and p), defaults to the usual cutoff for the criterion
+
+    Outputs:
+    A list with two elements:
+
+    1) A mapping like regional_data, but with the leverage points of each US Census Bureau region removed
+
+    2) A mapping where the keys are the US Census Bureau regions in a String and the values are a list of the dates removed from the dataset since they were leverage points
+    """
+
+    output_data_mapping = {}
+    output_indices_mapping = {}
+
+    regions = list(regional_data.keys())
+
+    x_list = [regional_data[region][0] for region in regions]
+    y_list = [regional_data[region][1] for region in regions]
+
+    keep_masks = flag_influential_points(x_list, y_list, criterion, threshold, max_iterations)
+
+    for region, keep in zip(regions, keep_masks):
+        x_data, y_data, dates = regional_data[region]
+
+        #Store the cleaned data and the dates of the points that were removed
+        output_data_mapping[region] = [x_data[keep], y_data[keep], dates[keep]]
+        output_indices_mapping[region] = dates[~keep].tolist()
+
+    return output_data_mapping, output_indices_mapping
 
 
-#SOMETHING IS GETTING FUCKED UP WITH THE LAG AND THE MATRIX_TO_MAPPING FUNCTION (TAKE A LOOK AT THE PRINTED DATAFRAMES AND GO FROM THERE)
-# print(clean_data(["2020-01-01", "2024-01-01"], "2-lags", "Linear", "Omit leverage points from dataset"))
 
 #Looking at the Midwest here
 # output_mapping = main_function(["2000-01-01", "2020-01-01"], "No lag", "Linear")['Midwest Region'][0]
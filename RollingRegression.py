@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import SufficientStatistics as stats
+from Instrumentation import instrumented
+
+
+@instrumented()
+def rolling_regression(window, type_of_regression = "No lag", type_of_fit = "No Transformation", expanding = False):
+    """
+    This function estimates the Phillips curve of every region over a window that slides through the whole history of the data, so we can
+    see how the slope changes over time. Rather than refitting every window from scratch, it reads the sufficient statistics of every window
+    (n and the sums of x, y, x x^T, y^2 and x*y for every region, where x is the row of the distributed-lag design) off the prefix sums of
+    SufficientStatistics.get_index: the sums of a window are the difference of two rows of the index, which is a constant amount of work no
+    matter how long the window is, and all of the windows are solved at once.
+
+    Inputs:
+
+    window - The number of months in each window (for an expanding window, the number of months in the first window)
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    expanding - If True, the start of the window stays at the first month and the window only grows
+
+    Outputs:
+    A dictionary with the keys "slope" (the long-run slope, the sum of the lag coefficients), "intercept" and "r2". Each value is a pandas dataframe indexed by the last date of each window with
+    one column per region.
+    """
+
+    index = stats.get_index(type_of_regression, type_of_fit)
+    dates = index["dates"]
+    regions = index["regions"]
+
+    if window < 3 or window > len(dates):
+        raise ValueError(f"The window must be between 3 and {len(dates)} months.")
+
+    # Window w covers the rows starts[w] to ends[w] - 1
+    ends = np.arange(window, len(dates) + 1)
+    starts = np.zeros(len(ends), dtype = int) if expanding else ends - window
+
+    coefficients, intercepts, r2_values, _ = stats.fit_ranges(index, starts, ends)
+
+    index_dates = pd.DatetimeIndex(pd.to_datetime(dates[window - 1:]), name = 'Time Period')
+
+    return {
+        "slope": pd.DataFrame(coefficients.sum(axis = 2), index = index_dates, columns = regions),
+        "intercept": pd.DataFrame(intercepts, index = index_dates, columns = regions),
+        "r2": pd.DataFrame(r2_values, index = index_dates, columns = regions),
+    }
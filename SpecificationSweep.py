@@ -0,0 +1,161 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import Regression as rg
+
+
+def build_grid(time_periods, lags = None, fits = None, leverages = None):
+    """
+    This function builds the full grid of regression specifications to sweep over.
+
+    Inputs:
+
+    time_periods - A list of [start date, end date] pairs (Strings in yyyy-mm-01 format)
+
+    lags - A list of types of regression (defaults to every key of Regression.LAGS)
+
+    fits - A list of types of fit (defaults to Regression.FIT_OPTIONS)
+
+    leverages - A list of ways to handle the leverage points (defaults to Regression.LEVERAGE_OPTIONS)
+
+    Outputs: A list of tuples (time period, type of regression, type of fit, leverage), one per specification
+    """
+
+    lags = list(rg.LAGS) if lags is None else lags
+    fits = rg.FIT_OPTIONS if fits is None else fits
+    leverages = rg.LEVERAGE_OPTIONS if leverages is None else leverages
+
+    return [(list(time_period), lag, fit, leverage) for time_period, lag, fit, leverage in itertools.product(time_periods, lags, fits, leverages)]
+
+
+def date_range_grid(start_dates, end_dates, min_months = 12):
+    """
+    This function pairs every start date with every end date that is at least min_months later (the dashboard requires at least a year).
+
+    Inputs:
+
+    start_dates - A list of start dates (Strings in yyyy-mm-01 format)
+
+    end_dates - A list of end dates (Strings in yyyy-mm-01 format)
+
+    min_months - The shortest time period allowed, in months
+
+    Outputs: A list of [start date, end date] pairs
+    """
+
+    time_periods = []
+    for start, end in itertools.product(start_dates, end_dates):
+        if pd.to_datetime(end) >= pd.to_datetime(start) + pd.DateOffset(months=min_months):
+            time_periods.append([start, end])
+
+    return time_periods
+
+
+def _sweep_chunk(type_of_regression, type_of_fit, specs):
+    """
+    Runs one chunk of the sweep inside a worker process. Every spec in the chunk shares the type of regression and the type of fit, so the
+    data is lined up once for the whole chunk and only the time period and the leverage handling change between fits.
+
+    Inputs:
+
+    type_of_regression - The type of regression shared by the chunk
+
+    type_of_fit - The type of fit shared by the chunk
+
+    specs - A list of (time period, leverage) pairs
+
+    Outputs: A list of dictionaries, one row of the results table per region and spec
+    """
+
+    history = rg.aligned_history(type_of_regression, type_of_fit)
+
+    rows = []
+    for time_period, leverage in specs:
+        for region, result in rg.fit_aligned(history, time_period, leverage).items():
+            rows.append({
+                "start": time_period[0],
+                "end": time_period[1],
+                "lag": type_of_regression,
+                "transform": type_of_fit,
+                "leverage": leverage,
+                "region": region,
+                "slope": sum(result["coefficients"]),
+                "intercept": result["intercept"],
+                "r2": result["r2"],
+                "n": result["n"],
+                "removed": result["removed"],
+            })
+
+    return rows
+
+
+def run_sweep(grid, workers = None, chunk_size = 200):
+    """
+    This function fits every specification in the grid on a pool of worker processes and collects the results into one table. No figures
+    are created. The specs are grouped by type of regression and type of fit so that each worker lines up the data once per group, and the
+    groups are split into chunks so that the work spreads over all of the cores.
+
+    Inputs:
+
+    grid - A list of specifications as returned by build_grid
+
+    workers - The number of worker processes (defaults to the number of cores). With 1 the sweep runs in this process.
+
+    chunk_size - The most specifications handed to a worker at a time
+
+    Outputs: A pandas dataframe with one row per region and specification and the columns start, end, lag, transform, leverage, region, slope
+    (the sum of the lag coefficients), intercept, r2, n and removed
+    """
+
+    # Grouping the specs that share the same lined up data
+    groups = {}
+    for time_period, lag, fit, leverage in grid:
+        groups.setdefault((lag, fit), []).append((time_period, leverage))
+
+    chunks = []
+    for (lag, fit), specs in groups.items():
+        for first in range(0, len(specs), chunk_size):
+            chunks.append((lag, fit, specs[first:first + chunk_size]))
+
+    workers = workers or os.cpu_count()
+
+    if workers == 1:
+        results = [_sweep_chunk(*chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_sweep_chunk, *zip(*chunks)))
+
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+def main():
+    """
+    Command line entry point for the specification sweep. Start and end dates default to the first month of every year in the data.
+    """
+
+    parser = argparse.ArgumentParser(description="Fit the regional Phillips curve over a grid of specifications.")
+    parser.add_argument("--start-dates", nargs="+", help="start dates in yyyy-mm-01 format")
+    parser.add_argument("--end-dates", nargs="+", help="end dates in yyyy-mm-01 format")
+    parser.add_argument("--min-months", type=int, default=12, help="shortest time period allowed, in months")
+    parser.add_argument("--lags", nargs="+", choices=list(rg.LAGS), help="types of regression to include")
+    parser.add_argument("--transforms", nargs="+", choices=rg.FIT_OPTIONS, help="types of fit to include")
+    parser.add_argument("--leverage", nargs="+", choices=rg.LEVERAGE_OPTIONS, help="ways to handle leverage points")
+    parser.add_argument("--workers", type=int, help="number of worker processes (defaults to the number of cores)")
+    parser.add_argument("--output", default="sweep_results.csv", help="path of the csv file to write the results to")
+    args = parser.parse_args()
+
+    yearly_dates = [date for date in rg.rpc.get_lookup_table("Inflation")["dates"] if date.endswith("-01-01")]
+
+    time_periods = date_range_grid(args.start_dates or yearly_dates, args.end_dates or yearly_dates, args.min_months)
+    grid = build_grid(time_periods, args.lags, args.transforms, args.leverage)
+
+    results = run_sweep(grid, args.workers)
+    results.to_csv(args.output, index=False)
+
+    print(f"Fit {len(grid)} specifications ({len(results)} regional regressions) and wrote the results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
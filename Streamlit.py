@@ -1,8 +1,58 @@
+import importlib
+import os
+import threading
 import streamlit as st
 import pandas as pd
 import RegionalPhillipsCurve as rpc
-import DataVisualizations as dv
 import Regression as rg
+import Instrumentation as instrumentation
+
+# DataVisualizations (geopandas, shapely, matplotlib), Bootstrap and RollingRegression are only imported when a map, confidence intervals or the
+# rolling regression are first asked for, so the first page is drawn without loading them
+
+# Above this many regions the user picks which regions get a regression plot
+MAX_PLOTTED_REGIONS = 8
+
+# Whether the heavy modules are loaded and every map is rendered in the background once the first page has been drawn. Set the environment
+# variable RPC_WARM_UP to 0 to switch it off (the maps are then drawn the first time they are asked for).
+WARM_UP = os.environ.get("RPC_WARM_UP", "1") != "0"
+
+
+@st.cache_data
+def date_options(variable, data_version):
+    """
+    Returns the dates of a dataset as a list for the date dropdowns. Streamlit keeps the list between reruns and sessions, and the version
+    of the data is part of the key so the list is rebuilt when the csv files change.
+    """
+
+    return list(rpc.get_lookup_table(variable)["dates"])
+
+
+def warm_up():
+    """
+    Loads the modules and the data that the maps, regressions and charts need and then renders every map into the rendered map cache, so
+    the first map or regression a user asks for doesn't pay for them.
+    """
+
+    # Importing the modules is all that is needed for the ones that aren't used here
+    import DataVisualizations as dv
+    for module in ("Bootstrap", "RollingRegression", "matplotlib.pyplot"):
+        importlib.import_module(module)
+
+    dv.get_region_geometry()
+    dv.prerender_maps()
+
+
+@st.cache_resource
+def start_warm_up():
+    """
+    Starts warm_up in a background thread. Streamlit only runs this once per server process, no matter how many sessions or reruns there are.
+    """
+
+    thread = threading.Thread(target = warm_up, name = "warm-up", daemon = True)
+    thread.start()
+
+    return thread
 
 
 def main():
@@ -25,8 +75,15 @@ def main():
     )
 
 
+    # The instrumentation is switched on for the whole server process while the panel is shown (it costs next to nothing when it is off)
+    show_instrumentation = st.sidebar.checkbox('Show performance instrumentation')
+    if show_instrumentation:
+        instrumentation.enable(memory=st.sidebar.checkbox('Trace memory allocations (slower)'))
+    elif instrumentation.is_enabled():
+        instrumentation.disable()
+
     # Create tabs
-    tabs = st.tabs(["Visualizing Unemployment & Inflation", "Phillips Curve Analysis"])
+    tabs = st.tabs(["Visualizing Unemployment & Inflation", "Phillips Curve Analysis", "Phillips Curve Over Time"])
 
     with tabs[0]:
         tab_one()
@@ -34,6 +91,39 @@ def main():
     with tabs[1]:
         tab_two()
 
+    with tabs[2]:
+        tab_three()
+
+    # Drawn last so that it includes the stages of this run
+    if show_instrumentation:
+        instrumentation_panel()
+
+    # Started after everything else so it never holds up the first page
+    if WARM_UP:
+        start_warm_up()
+
+
+def instrumentation_panel():
+    """
+    Shows the time, number of calls and memory of every stage of the pipeline (CSV loads, inflation, cleaning, leverage removal, fitting
+    and figure rendering) recorded since the instrumentation was switched on, in the sidebar.
+    """
+
+    with st.sidebar:
+        st.header("Performance")
+
+        stats = pd.DataFrame(instrumentation.get_span_stats())
+        if stats.empty:
+            st.write("Nothing has been recorded yet. Submit a model or pick a map to see where the time goes.")
+        else:
+            stats["total ms"] = stats["total_seconds"] * 1000
+            stats["mean ms"] = stats["mean_seconds"] * 1000
+            stats["peak KiB"] = stats["peak_bytes"] / 1024
+            st.dataframe(stats[["name", "calls", "total ms", "mean ms", "peak KiB"]].round(2), hide_index=True)
+
+        if st.button('Reset', key='instrumentation reset'):
+            instrumentation.reset_span_stats()
+
 
 def tab_one():
     """
@@ -57,20 +147,17 @@ def tab_one():
     The Bureau of Economic Analysis provides core CPI data by US Census Bureau region, which we use to calculate inflation. The Federal Reserve Economic Data (FRED) provides unemployment data by US Census Bureau region.
     """)
 
-    date_list = rpc.create_inflation()['Time Period'].values
+    date_list = date_options('Inflation', rpc.get_data_version())
     selected_date = st.selectbox('Choose a date:', date_list)
 
     selected_visualization = st.selectbox('Choose a visualization:', ['Unemployment', 'Inflation'])
 
     if st.button('Submit', key='tab 1'):
-        # Call function based on data_type
-        if selected_visualization == 'Unemployment':
-        
-            st.pyplot(dv.output_spatial_unemployment(selected_date))
-        
-        elif selected_visualization == 'Inflation':
-        
-            st.pyplot(dv.output_spatial_inflation(selected_date))
+        # The maps come out of the rendered map cache, which is filled in the background once the app has started
+        if selected_visualization in ['Unemployment', 'Inflation']:
+            import DataVisualizations as dv
+
+            st.image(dv.render_spatial_map(selected_visualization, selected_date), use_column_width=True)
         
         else:
             st.write('Error. Somehow you selected neither unemployment nor inflation. Please try again.')
@@ -78,7 +165,7 @@ def tab_one():
 def tab_two():
     """
     This tab looks at the Phillips Curve relationship between unemployment and inflation. It allows the user to select a start date
-    and an end date. When the user presses submit, 4 regression plots pop up (one for each region), showing the relationship between
+    and an end date. When the user presses submit, a regression plot pops up for each region, showing the relationship between
     unemployment and inflation as well as some summary statistics such as R^2. 
     """
 
@@ -108,7 +195,7 @@ def tab_two():
     """)
 
 
-    date_list = rpc.create_inflation()['Time Period'].values
+    date_list = date_options('Inflation', rpc.get_data_version())
     start_date = st.selectbox('Choose a start date:', date_list)
     end_date = st.selectbox('Choose an ends date:', date_list)
 
@@ -116,7 +203,17 @@ def tab_two():
 
     selected_model = st.selectbox('Choose a transformation:', ['No Transformation', 'Log transform y array'])
 
-    selected_leverage = st.selectbox('How do you want to deal with leverage points?:', ['Leave leverage points in dataset', 'Omit leverage points from dataset'])
+    selected_leverage = st.selectbox('How do you want to deal with leverage points?:', rg.LEVERAGE_OPTIONS)
+
+    # The bootstrap methods the user can pick for the 95% confidence intervals
+    interval_options = {'No confidence intervals': None, 'Pairs bootstrap': 'pairs', 'Residual bootstrap': 'residual', 'Block bootstrap (keeps serial correlation)': 'block'}
+    selected_interval = st.selectbox('Confidence intervals:', list(interval_options))
+
+    # Every region in the data gets a plot, unless there are so many (states, metro areas) that the user picks which ones to draw
+    regions = rpc.get_regions()
+    plotted_regions = regions
+    if len(regions) > MAX_PLOTTED_REGIONS:
+        plotted_regions = st.multiselect('Regions to plot:', regions, default=regions[:4])
 
     if st.button('Submit', key='tab 2'):
 
@@ -134,75 +231,130 @@ def tab_two():
         # Output mapping's values are a list with 4 elements: 1) fig, 2) r2, 3) intercept, 4) coefficient (3 and 4 are packaged in a list)
         output_mapping, indices_removed_mapping = rg.main_function([start_date, end_date], selected_lag, selected_model, selected_leverage)
 
-        figures = []
-        r2_values = []
-        intercepts = []
-        slopes = []
+        # The regression numbers are memoized across every session on the server, so popular specifications are only fit once
+        cache_stats = rg.get_result_cache_stats()
+        st.caption(f"Regression result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} results held")
+
+        # 10,000 resamples per region take well under a second, so the intervals are computed on every submit
+        intervals = None
+        if interval_options[selected_interval] is not None:
+            import Bootstrap as bs
+            intervals = bs.bootstrap_confidence_intervals([start_date, end_date], selected_lag, selected_model, selected_leverage, method=interval_options[selected_interval], n_resamples=10000)
+
+        r2_values = {}
+        intercepts = {}
+        slopes = {}
 
         for region in output_mapping.keys():
-            figures.append(output_mapping[region][0])
-            r2_values.append(output_mapping[region][1])
-            intercepts.append(output_mapping[region][2])
-            slopes.append(output_mapping[region][3][0])
-
-        # Create a 2x2 grid layout
-        col1, col2 = st.columns([2,2])
-
-        # Display the first row of plots
-        with col1:
-            st.pyplot(figures[0])
-            st.markdown(f"**R²:** {r2_values[0]:.2f}")
-            st.markdown(f"**Intercept:** {intercepts[0]:.2f}")
-            st.markdown(f"**Slope:** {slopes[0]:.2f}")
-
-            #We only want to display the leverage points removed if the user selected to omit leverage points from the dataset
-            if(selected_leverage == 'Omit leverage points from dataset'):
-                #Have to do special formatting for my leverage points
-                midwest_header = "Leveraged Indices Removed"
-                midwest_markdown_list = "\n".join([f"- {item}" for item in indices_removed_mapping['Midwest Region']])
-                st.markdown(f"**{midwest_header}**\n\n{midwest_markdown_list}")
-
-        with col2:
-            st.pyplot(figures[1])
-            st.markdown(f"**R²:** {r2_values[1]:.2f}")
-            st.markdown(f"**Intercept:** {intercepts[1]:.2f}")
-            st.markdown(f"**Slope:** {slopes[1]:.2f}")
-            
-            #We only want to display the leverage points removed if the user selected to omit leverage points from the dataset
-            if(selected_leverage == 'Omit leverage points from dataset'):
-                #Have to do special formatting for my leverage points
-                northeast_header = "Leveraged Indices Removed"
-                northeast_markdown_list = "\n".join([f"- {item}" for item in indices_removed_mapping['Northeast Region']])
-                st.markdown(f"**{northeast_header}**\n\n{northeast_markdown_list}")
-
-        # Create a second row of plots
-        col3, col4 = st.columns([2,2])
-
-        with col3:
-            st.pyplot(figures[2])
-            st.markdown(f"**R²:** {r2_values[2]:.2f}")
-            st.markdown(f"**Intercept:** {intercepts[2]:.2f}")
-            st.markdown(f"**Slope:** {slopes[2]:.2f}")
-            
-            #We only want to display the leverage points removed if the user selected to omit leverage points from the dataset
-            if(selected_leverage == 'Omit leverage points from dataset'):
-                #Have to do special formatting for my leverage points
-                south_header = "Leveraged Indices Removed"
-                south_markdown_list = "\n".join([f"- {item}" for item in indices_removed_mapping['South Region']])
-                st.markdown(f"**{south_header}**\n\n{south_markdown_list}")
-
-        with col4:
-            st.pyplot(figures[3])
-            st.markdown(f"**R²:** {r2_values[3]:.2f}")
-            st.markdown(f"**Intercept:** {intercepts[3]:.2f}")
-            st.markdown(f"**Slope:** {slopes[3]:.2f}")
-            
-            #We only want to display the leverage points removed if the user selected to omit leverage points from the dataset
-            if(selected_leverage == 'Omit leverage points from dataset'):
-                #Have to do special formatting for my leverage points
-                west_header = "Leveraged Indices Removed"
-                west_markdown_list = "\n".join([f"- {item}" for item in indices_removed_mapping['West Region']])
-                st.markdown(f"**{west_header}**\n\n{west_markdown_list}")
+            r2_values[region] = output_mapping[region][1]
+            intercepts[region] = f"**Intercept:** {output_mapping[region][2]:.2f}"
+            # With lags, the slope shown is the long-run slope (the sum of the lag coefficients) followed by the coefficient of every lag
+            coefficients = output_mapping[region][3]
+            slope_text = f"**Slope:** {coefficients[0]:.2f}" if len(coefficients) == 1 else f"**Long-run slope:** {sum(coefficients):.2f}"
+
+            if intervals is not None:
+                intercepts[region] += " (95% CI: {:.2f} to {:.2f})".format(*intervals[region]["intercept"])
+                slope_text += " (95% CI: {:.2f} to {:.2f})".format(*intervals[region]["slope"])
+
+            if len(coefficients) > 1:
+                lag_coefficients = ", ".join(f"{coefficient:.2f}" for coefficient in coefficients)
+                slope_text += f"  \nLag coefficients u(t) to u(t-{len(coefficients) - 1}): {lag_coefficients}"
+            slopes[region] = slope_text
+
+        # With many regions, the numbers of all of them are shown in a table as well as the plots of the chosen ones
+        if len(regions) > MAX_PLOTTED_REGIONS:
+            st.dataframe(pd.DataFrame([output_mapping[region].to_record() for region in regions]).drop(columns=['coefficients']), hide_index=True)
+
+        # Laying the plots out in a grid with two regions per row
+        for first in range(0, len(plotted_regions), 2):
+            for column, region in zip(st.columns([2,2]), plotted_regions[first:first + 2]):
+                with column:
+                    st.pyplot(output_mapping[region][0])
+                    st.markdown(f"**R²:** {r2_values[region]:.2f}")
+                    st.markdown(intercepts[region])
+                    st.markdown(slopes[region])
+
+                    #We only want to display the leverage points removed if the user selected to omit points from the dataset
+                    if(selected_leverage != 'Leave leverage points in dataset'):
+                        #Have to do special formatting for my leverage points
+                        header = "Leveraged Indices Removed"
+                        markdown_list = "\n".join([f"- {item}" for item in indices_removed_mapping[region]])
+                        st.markdown(f"**{header}**\n\n{markdown_list}")
+
+        # The figures have been turned into images by now, so we let go of them instead of keeping them around for the life of the server
+        for result in output_mapping.values():
+            result.close()
+
+
+def tab_three():
+    """
+    This tab shows how the Phillips Curve relationship has changed over time. The regression is fit over a window that slides through the
+    whole history of the data, and the slope, intercept and R^2 of every window are charted by region. Below that, a structural break scan
+    charts the Chow F statistic of every candidate breakpoint and reports the most likely break of every region.
+    """
+
+    st.title("The Phillips Curve Over Time")
+
+    st.write("""
+    # Overview
+
+    A single regression over a long time period hides how the Phillips Curve has changed. Here the regression is fit over a window of months that slides
+             through the data, and every point on the charts is the result for the window ending on that date. Choose an expanding window to always start
+             at the beginning of the data instead.
+    """)
+
+    window = st.slider('Window length (months):', min_value=24, max_value=240, value=60, step=12)
+
+    window_type = st.selectbox('Choose a type of window:', ['Rolling', 'Expanding'])
+
+    selected_lag = st.selectbox('Choose a type of regression:', list(rg.LAGS.keys()), key='tab 3 lag')
+
+    selected_model = st.selectbox('Choose a transformation:', ['No Transformation', 'Log transform y array'], key='tab 3 model')
+
+    if st.button('Submit', key='tab 3'):
+        import RollingRegression as rr
+
+        rolling_results = rr.rolling_regression(window, selected_lag, selected_model, expanding=(window_type == 'Expanding'))
+
+        st.markdown("**Slope**")
+        st.line_chart(rolling_results["slope"])
+
+        st.markdown("**Intercept**")
+        st.line_chart(rolling_results["intercept"])
+
+        st.markdown("**R²**")
+        st.line_chart(rolling_results["r2"])
+
+    st.write("""
+    # Structural Breaks
+
+    Where did the curve change? Every month is tried as a breakpoint: the regression is fit separately before and after it, and the Chow F statistic
+             measures how much better the two fits are than one fit over the whole time period. The month with the largest statistic (the sup-F) is the most
+             likely break. The type of regression and transformation chosen above are used, and the first and last 15% of the months aren't tried.
+    """)
+
+    date_list = date_options('Inflation', rpc.get_data_version())
+    break_start = st.selectbox('Choose a start date:', date_list, key='tab 3 break start')
+    break_end = st.selectbox('Choose an end date:', date_list, index=len(date_list) - 1, key='tab 3 break end')
+
+    if st.button('Find breaks', key='tab 3 breaks'):
+        import StructuralBreaks as sb
+
+        try:
+            breaks = sb.break_scan([break_start, break_end], selected_lag, selected_model)
+        except ValueError as error:
+            st.write(f":red[ERROR:] {error}")
+            return
+
+        st.markdown("**Chow F statistic by breakpoint**")
+        st.line_chart(breaks["profile"])
+
+        for region, result in breaks["sup_f"].items():
+            if result["date"] is None:
+                st.markdown(f"**{region}:** no break could be estimated")
+                continue
+            st.markdown(f"**{region}:** most likely break in {result['date']} (sup-F {result['f_stat']:.1f}). "
+                        f"Long-run slope {result['slope_before']:.2f} before, {result['slope_after']:.2f} after.")
 
 
 
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+import Regression as rg
+import SufficientStatistics as stats
+from Instrumentation import instrumented
+
+# The share of the months at each end of the time period that can't be a breakpoint, so both regimes always have enough data (the usual
+# choice for the Quandt likelihood ratio test)
+DEFAULT_TRIM = 0.15
+
+
+def _segment_fits(index, starts, ends):
+    """
+    Fits every region over the rows starts to ends - 1 of the sufficient statistics index and returns the sum of squared residuals along with
+    the fits.
+
+    Outputs: A tuple of the sums of squared residuals, the coefficients and the intercepts, each with a leading axis of ranges and then regions
+    """
+
+    _, n, _, sum_y, _, sum_yy, _ = stats.range_sums(index, starts, ends)
+    coefficients, intercept, r2, _ = stats.fit_ranges(index, starts, ends)
+
+    # The R^2 is the explained share of the centered sum of squares of y, so what is left over is the sum of squared residuals
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        total = sum_yy - sum_y * sum_y / n
+
+    return np.clip((1 - r2) * total, 0, None), coefficients, intercept
+
+
+@instrumented()
+def break_scan(time_period, type_of_regression = "No lag", type_of_fit = "No Transformation", trim = DEFAULT_TRIM):
+    """
+    This function looks for the month the Phillips curve of every region changed (a structural break). Every admissible month is tried as
+    the breakpoint: the regression is fit separately before and after it, and the Chow F statistic compares the two fits to the single fit
+    over the whole time period. The month with the largest statistic (the sup-F, or Quandt likelihood ratio) is the most likely break.
+    Every fit comes from the prefix sums of SufficientStatistics.get_index, so the scan is a constant amount of work per candidate month
+    rather than two regressions, and every region is scanned at once.
+
+    The sup-F statistic doesn't follow the usual F distribution (the breakpoint was picked because it gives the largest statistic), so it has
+    to be compared to the critical values of Andrews (1993) rather than an F table.
+
+    Inputs:
+
+    time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    trim - The share of the months at each end of the time period that isn't tried as a breakpoint (between 0 and 0.5)
+
+    Outputs:
+    A dictionary with the keys:
+
+    "profile" - A pandas dataframe of the Chow F statistics indexed by the breakpoint (the first month of the second regime) with one column per region
+
+    "sup_f" - A dictionary that maps a region to a dictionary with the breakpoint with the largest statistic ("date"), the statistic ("f_stat"),
+    and the long-run slope and intercept before ("slope_before", "intercept_before") and after ("slope_after", "intercept_after") the break
+    """
+
+    if not 0 < trim < 0.5:
+        raise ValueError("The trimming must be between 0 and 0.5.")
+
+    index = stats.get_index(type_of_regression, type_of_fit)
+    dates = index["dates"]
+    regions = index["regions"]
+    rows = rg.period_rows(dates, time_period)
+    first, last = rows.start, rows.stop
+
+    # Every regime needs more observations than the regression has coefficients (the intercept and one per lag)
+    n_coefficients = index["sum_x"].shape[2] + 1
+    margin = max(int(np.ceil(trim * (last - first))), n_coefficients + 1)
+    candidates = np.arange(first + margin, last - margin + 1)
+
+    if len(candidates) == 0:
+        raise ValueError("The time period is too short to look for a structural break.")
+
+    full_ssr, _, _ = _segment_fits(index, first, last)
+    before_ssr, before_coefficients, before_intercepts = _segment_fits(index, np.full(len(candidates), first), candidates)
+    after_ssr, after_coefficients, after_intercepts = _segment_fits(index, candidates, np.full(len(candidates), last))
+
+    # Chow test of whether the intercept and the lag coefficients are the same in both regimes
+    split_ssr = before_ssr + after_ssr
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        f_stats = ((full_ssr - split_ssr) / n_coefficients) / (split_ssr / (last - first - 2 * n_coefficients))
+
+    profile = pd.DataFrame(f_stats, index = pd.DatetimeIndex(pd.to_datetime(dates[candidates]), name = 'Breakpoint'), columns = regions)
+
+    sup_f = {}
+    for position, region in enumerate(regions):
+        if np.isnan(f_stats[:, position]).all():
+            sup_f[region] = {"date": None, "f_stat": float('nan'), "slope_before": float('nan'), "intercept_before": float('nan'),
+                             "slope_after": float('nan'), "intercept_after": float('nan')}
+            continue
+
+        best = int(np.nanargmax(f_stats[:, position]))
+        sup_f[region] = {
+            "date": dates[candidates[best]],
+            "f_stat": float(f_stats[best, position]),
+            "slope_before": float(before_coefficients[best, position].sum()),
+            "intercept_before": float(before_intercepts[best, position]),
+            "slope_after": float(after_coefficients[best, position].sum()),
+            "intercept_after": float(after_intercepts[best, position]),
+        }
+
+    return {"profile": profile, "sup_f": sup_f}
+
+
+def sup_f_table(time_period, type_of_fit = "No Transformation", trim = DEFAULT_TRIM):
+    """
+    Runs break_scan for every type of regression (every number of lags) and collects the most likely break of every region and lag.
+
+    Inputs: the same as break_scan
+
+    Outputs: A pandas dataframe with one row per type of regression and region and the columns "lag", "region", "date", "f_stat",
+    "slope_before", "intercept_before", "slope_after" and "intercept_after"
+    """
+
+    rows = []
+    for type_of_regression in rg.LAGS:
+        for region, result in break_scan(time_period, type_of_regression, type_of_fit, trim)["sup_f"].items():
+            rows.append({"lag": type_of_regression, "region": region, **result})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,230 @@
+import threading
+import numpy as np
+import pandas as pd
+import RegionalPhillipsCurve as rpc
+import Regression as rg
+from Instrumentation import instrumented
+
+# The prefix sums of every (type of regression, type of fit) that has been asked for, with the data version they were built from
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def fit_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy):
+    """
+    This function turns the sufficient statistics of a regression into its coefficients, intercept and R^2. The inputs can have any number of
+    leading axes (such as regions, or windows and regions), so many regressions are solved at once.
+
+    Inputs: n, sum_x, sum_y, sum_xx, sum_yy, sum_xy - the number of observations and the sums of x, y, x x^T, y^2 and x*y, where x is the row
+    of the distributed-lag design (so sum_x and sum_xy have shape (..., lags + 1) and sum_xx has shape (..., lags + 1, lags + 1))
+
+    Outputs: A tuple of three numpy arrays: the coefficients (shape (..., lags + 1)), the intercepts and the R^2 values
+    """
+
+    sxx = sum_xx - sum_x[..., :, None] * sum_x[..., None, :] / n[..., None, None]
+    syy = sum_yy - sum_y * sum_y / n
+    sxy = sum_xy - sum_x * sum_y[..., None] / n[..., None]
+
+    # Same minimum norm solution as the batched solve when unemployment doesn't vary over a time period
+    coefficients = np.einsum('...ij,...j->...i', np.linalg.pinv(sxx, hermitian = True), sxy)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        intercept = (sum_y - np.einsum('...i,...i->...', coefficients, sum_x)) / n
+        r2 = np.where(syy > 0, np.einsum('...i,...i->...', coefficients, sxy) / syy, 1.0)
+
+    return coefficients, intercept, r2
+
+
+def _build_index(type_of_regression, type_of_fit):
+    """
+    Builds the prefix sums of the sufficient statistics over the lined up history of the data (see get_index).
+    """
+
+    dates, x_data, y_data, regions = rg.aligned_history(type_of_regression, type_of_fit)
+
+    # A month with no usable value (the log of a negative inflation rate) is counted rather than summed, so it only spoils the time periods that contain it
+    valid = np.isfinite(y_data) & np.isfinite(x_data).all(axis = 2)
+
+    # The data is centered on the mean of every region before it is summed. The regression is the same apart from the intercept, which is
+    # shifted back at the end, and the differences of the prefix sums lose far less precision than they would on the raw values.
+    x_shift = np.array([x_data[valid[:, index], index].mean(axis = 0) if valid[:, index].any() else np.zeros(x_data.shape[2]) for index in range(len(regions))])
+    y_shift = np.array([y_data[valid[:, index], index].mean() if valid[:, index].any() else 0.0 for index in range(len(regions))])
+
+    x_centered = np.where(valid[:, :, None], x_data - x_shift, 0.0)
+    y_centered = np.where(valid, y_data - y_shift, 0.0)
+
+    def prefix(values):
+        # Row i of the prefix sums is the sum of the first i months, so the sums of the rows a to b - 1 are row b minus row a
+        return np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis = 0)])
+
+    return {
+        "dates": dates,
+        "regions": list(regions),
+        "x_shift": x_shift,
+        "y_shift": y_shift,
+        "n": prefix(valid.astype(np.float64)),
+        "invalid": prefix((~valid).astype(np.float64)),
+        "sum_x": prefix(x_centered),
+        "sum_y": prefix(y_centered),
+        "sum_xx": prefix(x_centered[:, :, :, None] * x_centered[:, :, None, :]),
+        "sum_yy": prefix(y_centered ** 2),
+        "sum_xy": prefix(x_centered * y_centered[:, :, None]),
+    }
+
+
+@instrumented()
+def get_index(type_of_regression, type_of_fit):
+    """
+    This function returns the sufficient statistics index of a type of regression and a type of fit. A regression without leverage removal only
+    depends on n and the sums of x, y, x x^T, y^2 and x*y (where x is the row of the distributed-lag design), so the index keeps the running
+    totals of those sums over the whole history of every region. The sums over any time period are then the difference of two rows of the
+    index, which is a constant amount of work however long the time period is. The index is built once per type of regression and type of fit
+    and rebuilt when the data changes.
+
+    Inputs:
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    Outputs:
+    A dictionary with the dates of the lined up history ("dates"), the regions ("regions"), the means the data was centered on ("x_shift" and
+    "y_shift") and the prefix sums ("n", "invalid", "sum_x", "sum_y", "sum_xx", "sum_yy" and "sum_xy"), each with one more row than there are dates
+    """
+
+    key = (type_of_regression, type_of_fit)
+    version = rpc.get_data_version()
+
+    with _index_lock:
+        entry = _index_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+    index = _build_index(type_of_regression, type_of_fit)
+
+    with _index_lock:
+        _index_cache[key] = (version, index)
+
+    return index
+
+
+def range_sums(index, starts, ends):
+    """
+    Returns the sufficient statistics of the rows starts to ends - 1 of the index, for arrays of starts and ends (or single rows).
+
+    Outputs: A tuple of the number of invalid months and the n, sum_x, sum_y, sum_xx, sum_yy and sum_xy of every range and region
+    """
+
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+
+    return tuple(index[name][ends] - index[name][starts] for name in ["invalid", "n", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"])
+
+
+def fit_ranges(index, starts, ends):
+    """
+    Fits every region over the rows starts to ends - 1 of the index, for arrays of starts and ends. A range that contains a month without a
+    usable value gets NaNs, the same as a direct fit would.
+
+    Outputs: A tuple of four numpy arrays with a leading axis of ranges and then regions: the coefficients, the intercepts, the R^2 values and n
+    """
+
+    invalid, n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = range_sums(index, starts, ends)
+
+    coefficients, intercept, r2 = fit_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+
+    # Undoing the centering: the coefficients and R^2 don't change, the intercept moves back to the scale of the data
+    intercept = intercept + index["y_shift"] - np.einsum('...i,...i->...', coefficients, index["x_shift"])
+
+    spoiled = invalid > 0
+    coefficients = np.where(spoiled[..., None], np.nan, coefficients)
+    intercept = np.where(spoiled, np.nan, intercept)
+    r2 = np.where(spoiled, np.nan, r2)
+
+    return coefficients, intercept, r2, n + invalid
+
+
+def range_regression(time_period, type_of_regression, type_of_fit):
+    """
+    This function fits every region over a time period from the sufficient statistics index, giving the same numbers as main_function with
+    the leverage points left in, in microseconds rather than milliseconds once the index is built.
+
+    Inputs:
+
+    time_period - A list of two elements where the first element is a String of the start date and the second element is a String of the end date
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    Outputs:
+    A dictionary that maps a region to a dictionary with the R^2 value ("r2"), the intercept ("intercept"), the list of coefficients ("coefficients", one
+    per lag), the long-run slope ("slope", the sum of the coefficients) and the number of observations ("n")
+    """
+
+    index = get_index(type_of_regression, type_of_fit)
+    rows = rg.period_rows(index["dates"], time_period)
+
+    if rows.stop - rows.start < 3:
+        raise ValueError("The time period must contain at least 3 months of data.")
+
+    coefficients, intercept, r2, n = fit_ranges(index, rows.start, rows.stop)
+
+    output_mapping = {}
+    for position, region in enumerate(index["regions"]):
+        output_mapping[region] = {
+            "r2": float(r2[position]),
+            "intercept": float(intercept[position]),
+            "coefficients": coefficients[position].tolist(),
+            "slope": float(coefficients[position].sum()),
+            "n": int(n[position]),
+        }
+
+    return output_mapping
+
+
+@instrumented()
+def range_scan(type_of_regression = "No lag", type_of_fit = "No Transformation", min_months = 24):
+    """
+    This function fits every region over every time period (every pair of a start month and an end month at least min_months apart) in the
+    history of the data. Each fit is a difference of prefix sums, so the scan only costs a small solve per time period. The time periods are
+    handled one start month at a time to keep the memory down.
+
+    Inputs:
+
+    type_of_regression - A string that is either "No lag", "1-lag", "2-lags", "3-lags", or "4-lags" that specifies the type of regression
+
+    type_of_fit - A string that is either "No Transformation" or "Log transform y array" that specifies the type of fit
+
+    min_months - The fewest months in a time period (at least 3)
+
+    Outputs:
+    A pandas dataframe with one row per time period and region and the columns "start", "end", "region", "n", "slope", "intercept" and "r2"
+    """
+
+    if min_months < 3:
+        raise ValueError("The time periods must contain at least 3 months.")
+
+    index = get_index(type_of_regression, type_of_fit)
+    dates = index["dates"]
+    regions = index["regions"]
+
+    frames = []
+    for start in range(len(dates) - min_months + 1):
+        ends = np.arange(start + min_months, len(dates) + 1)
+        coefficients, intercept, r2, n = fit_ranges(index, np.full(len(ends), start), ends)
+
+        frames.append(pd.DataFrame({
+            "start": dates[start],
+            "end": np.repeat(dates[ends - 1], len(regions)),
+            "region": np.tile(regions, len(ends)),
+            "n": n.ravel().astype(int),
+            "slope": coefficients.sum(axis = 2).ravel(),
+            "intercept": intercept.ravel(),
+            "r2": r2.ravel(),
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=["start", "end", "region", "n", "slope", "intercept", "r2"])
+
+    return pd.concat(frames, ignore_index=True)